@@ -18,13 +18,53 @@
 #   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
 
 
-import sys,argparse
+import sys,os,time,argparse,itertools,contextlib
 from dsarsim.simulator import simulator
+from dsarsim.profiling import profiler
 from dsarsim.common.image import image
+from dsarsim.common.cache import rotation_cache,result_cache
+from dsarsim.service import simulation_service,serve
 
 STATE_OK=0
 STATE_ERROR=1
 
+def parse_batch(batch,batch_grid):
+    """ Returns the list of (ia,aa,d) configurations given by the --batch and --batchGrid options. """
+    configurations=list()
+    if batch is not None:
+        for item in batch.split(';'):
+            if item.strip()!="":
+                ia,aa,d=item.split(',')
+                configurations.append((float(ia),float(aa),d.strip()))
+    if batch_grid is not None:
+        ia_list=[float(ia) for ia in batch_grid[0].split(',')]
+        aa_list=[float(aa) for aa in batch_grid[1].split(',')]
+        d_list=[d.strip() for d in batch_grid[2].split(',')]
+        configurations.extend(itertools.product(ia_list,aa_list,d_list))
+    for configuration in configurations:
+        if configuration[2] not in ('w','e'):
+            raise ValueError("invalid direction '"+configuration[2]+"'")
+    return configurations
+
+
+def batch_output_filename(output_filename,configuration):
+    """ Output file name of one batch configuration: output_filename can contain the {ia}, {aa} and {d} fields,
+    otherwise a suffix with the configuration parameters is added before the extension. """
+    ia,aa,d=configuration
+    fields={'ia':'%g' % ia,'aa':'%g' % aa,'d':d}
+    if '{' in output_filename:
+        return output_filename.format(**fields)
+    root,ext=os.path.splitext(output_filename)
+    return root+"_ia{ia}_aa{aa}_{d}".format(**fields)+ext
+
+
+def print_progress(record):
+    """ Progress callback of the simulator in debug mode (see parallel.row_monitor). """
+    eta="" if record['eta_seconds'] is None else ", ETA %.0f s" % record['eta_seconds']
+    rate="" if record['rows_per_second'] is None else ", %.0f rows/s" % record['rows_per_second']
+    print("INFO: Simulated rows: %d/%d (%.0f%%)" % (record['rows_done'],record['rows'],100.*record['rows_done']/max(1,record['rows']))+rate+eta)
+
+
 def main(argv=None):
 
     if argv is None:
@@ -35,8 +75,8 @@ def main(argv=None):
     output_filename=""
 
     parser=argparse.ArgumentParser(description='Generates a pseudo-SAR image starting from a DTM/DSM.')
-    parser.add_argument('-i','--input',required=True,help='input DTM/DSM image (32 bit floating-point GeoTIFF image).')
-    parser.add_argument('-o','--output',required=True,help='output image (same format as input).')
+    parser.add_argument('-i','--input',default=None,help='input DTM/DSM image (32 bit floating-point GeoTIFF image). Required unless serving.')
+    parser.add_argument('-o','--output',default=None,help='output image (same format as input). Required unless serving.')
     parser.add_argument('-ai','--incidenceAngle',default='30',type=float,help='SAR incidence angle in degrees. Default is 30.')
     parser.add_argument('-aa','--aspectAngle',default='0',type=float,help='angle wrt the North-South axis. aspect angle > 0 = clockwise. Default is 0.')
     parser.add_argument('-pa','--azimuthPixelSpacing',type=float,default='0',help="spacing between azimuth pixels in the output image in meters, or 0 if automatically set as the same spacing of the input DTM/DSM. Default is 0.")
@@ -45,7 +85,34 @@ def main(argv=None):
     parser.add_argument('-n','--noDataValue',type=float,default='-9999',help="no data value used in the DTM/DSM image, if any. Default is -9999.")
     parser.add_argument('-r','--rotateBack',default=False,action='store_true',help='if aspect angle != 0, rotate back output image by -aspect angle degrees. Use only if azimuthPixelSpacing and slantRangePixelSpacing are not set by user in order to get simulations directly comparable to input DTM/DSM. Default is not set.')
     parser.add_argument('-s','--subprocesses',default='1',type=int,help="number of concurrent threads to be run (works only if the module multiprocessing is installed). Default is 1.")
-    parser.add_argument('--debug',action='store_true',default=False,help='debug mode. Default is not set.')
+    parser.add_argument('-e','--engine',default='reference',choices=['reference','vectorized'],help="row simulation engine. 'reference' = pixel by pixel simulation, 'vectorized' = array based simulation giving the same results, faster on large images. Default is 'reference'.")
+    parser.add_argument('-b','--backend',default='pool',choices=['pool','shared_memory','threads','auto'],help="parallel backend. 'pool' = rows sent to the subprocesses by chunks (about four per subprocess) and collected as they are done, 'shared_memory' = input and output images in shared memory, one task per block of rows, 'threads' = threads sharing input and output images, one task per block of rows (useful with the vectorized engine only), 'auto' = chosen according to engine, image size and number of CPU cores (no subprocesses at all for small images). Default is 'pool'.")
+    parser.add_argument('--oblique',default='rotate',choices=['rotate','trace'],help="how the input image is brought to the viewing geometry when aspect angle != 0 or direction = 'e'. 'rotate' = cubic spline rotation of the whole image, 'trace' = the range lines are traced through the input image along the viewing direction, over their valid extent only, taking the nearest pixel heights, and simulated by strips straight into the output geometry: the rotated image is never built and heights are not interpolated (sharp building edges, no artifacts near nodata areas). Default is 'rotate'.")
+    parser.add_argument('--streaming',default=False,action='store_true',help='streaming mode: the input image is read and simulated by strips of rows and the output is written incrementally, so that images larger than the available memory can be simulated. Not compatible with azimuthPixelSpacing, slantRangePixelSpacing and rotateBack. Default is not set.')
+    parser.add_argument('--stripRows',default='256',type=int,help='number of rows of each strip in streaming mode. Default is 256.')
+    parser.add_argument('--layers',default=False,action='store_true',help='also write the shadow mask (1 = shadowed DTM/DSM pixel), the layover mask (1 = output pixel in a layover area) and the lookup table giving, for each DTM/DSM pixel, row and column of the corresponding output pixel (-1 if none), as bands 2 to 5 of the output image. Shadow mask and lookup table are in the geometry of the input image (rotated by the aspect angle, unless rotateBack is set), scatterer count and layover mask in the output slant range geometry. Not compatible with azimuthPixelSpacing and slantRangePixelSpacing. Default is not set.')
+    parser.add_argument('--outputType',default='float32',choices=['float32','auto','uint8','uint16'],help="data type of the output image. 'auto' = smallest integer type holding the maximum scatterer count (16 bit integers in streaming mode); larger values are clipped with uint8 and uint16. With --layers, integer types are signed (the lookup table holds -1 values). Default is 'float32'.")
+    parser.add_argument('--compress',default=None,choices=['DEFLATE','ZSTD','LZW'],help='compression of the output image, which is then written as a tiled GeoTIFF (256x256 pixels tiles, with floating point predictor for float32 outputs and horizontal differencing predictor for integer ones). BigTIFF is used automatically when needed. Default is not set (no compression).')
+    parser.add_argument('--overviews',default=False,action='store_true',help='add overviews (reduction factors 2, 4, 8... down to 256 pixels) to the output image. Default is not set.')
+    parser.add_argument('--preview',default=False,action='store_true',help='preview mode: the simulation is carried out on a reduced resolution version of the input image (read from the GDAL overviews of the input file, if any, or computed by block averaging) and the preview is written to OUTPUT. The input image is not loaded entirely. Default is not set.')
+    parser.add_argument('--previewLevel',default=None,type=int,help='reduction level of the preview: the input image is reduced by 2^PREVIEWLEVEL. Default is the first level with at most 2^18 pixels.')
+    parser.add_argument('--batch',default=None,help="batch mode: semicolon separated list of incidenceAngle,aspectAngle,direction configurations to be simulated on the same input, e.g. '30,0,w;45,0,w;30,90,e'. The input image is rotated once for each aspect angle+direction, the incidence angles sharing aspect angle and direction are simulated together in one pass over the rows (up to 8 at a time) and the subprocesses are kept alive for the whole batch. OUTPUT can contain the {ia}, {aa} and {d} fields, otherwise a suffix with the configuration parameters is added to each output file name. Default is not set.")
+    parser.add_argument('--batchGrid',default=None,nargs=3,metavar=('IA_LIST','AA_LIST','D_LIST'),help="batch mode on the grid of the given comma separated incidence angles, aspect angles and directions, e.g. '20,30,40 0,90 w,e'. Can be combined with --batch. Default is not set.")
+    parser.add_argument('--cacheDir',default=None,help='directory of the cache of rotated input images: simulations with an aspect angle+direction already used on the same input reuse the cached rotation. Default is not set (no cache).')
+    parser.add_argument('--cacheSize',default='4096',type=float,help='maximum size of the cache of rotated input images in MB; least recently used files are removed first. Default is 4096.')
+    parser.add_argument('--resultCacheDir',default=None,help='directory of the cache of output images: simulations already run on the same input image content with the same parameters are not run again, the cached output image is copied to OUTPUT instead. Preview outputs are not cached. Default is not set (no cache).')
+    parser.add_argument('--resultCacheSize',default='4096',type=float,help='maximum size of the cache of output images in MB; least recently used files are removed first. Default is 4096.')
+    parser.add_argument('--resultCacheLink',default=False,action='store_true',help='cached output images are hard linked to OUTPUT instead of copied (when on the same file system): faster and no extra disk space, but OUTPUT must not be modified in place. Default is not set.')
+    parser.add_argument('--heightEstimator',default='full',choices=['full','input','sample','gdal'],help="estimator of the reference height used to center the output image. 'full' = histogram of all the pixels of the rotated input image, 'input' = histogram of all the pixels of the not rotated input image, computed once for all the aspect angles, 'sample' = histogram of a regular sample of the not rotated input image, 'gdal' = histogram computed by GDAL, using the overviews of the input file if any. Default is 'full'.")
+    parser.add_argument('--heightSampleRate',default='0.01',type=float,help="fraction of the input pixels used by the 'sample' height estimator (at least 10^6 pixels are used). Default is 0.01.")
+    parser.add_argument('--profile',default=None,help='write the timings of the simulation stages (wall and CPU time, peak memory, rows per second of each subprocess) to the given JSON file. Default is not set.')
+    parser.add_argument('--profileWorkers',default=False,action='store_true',help='with --profile, also run the row simulations under cProfile and add the most time consuming functions to the JSON file (not with the threads backend: only one profiler can be active in a process). Default is not set.')
+    parser.add_argument('--serve',default=None,metavar='ADDRESS',help="service mode: simulation jobs are received through a local HTTP interface on ADDRESS, a Unix socket path (if it contains a '/') or [HOST:]PORT (default host 127.0.0.1), and queued; input images and worker pools are kept in memory between jobs. Jobs are submitted as JSON objects with the long names of the simulation options (e.g. {\"input\": \"dem.tif\", \"output\": \"sim.tif\", \"incidenceAngle\": 35}) to POST /jobs and followed with GET /jobs/ID, GET /jobs/ID?wait=SECONDS or GET /jobs/ID/events, and cancelled with POST /jobs/ID/cancel. subprocesses, engine, backend, heightEstimator and the cache options apply to all the jobs. Default is not set.")
+    parser.add_argument('--serveRunners',default='1',type=int,help='number of jobs simulated concurrently in service mode, each with SUBPROCESSES subprocesses. Default is 1.')
+    parser.add_argument('--queueSize',default='64',type=int,help='maximum number of jobs waiting in the queue in service mode; further jobs are rejected. Default is 64.')
+    parser.add_argument('--imageCacheSize',default='2048',type=float,help='maximum size of the input images kept in memory in service mode in MB; least recently used images are dropped first. Default is 2048.')
+    parser.add_argument('--timeout',default=None,type=float,help='maximum run time in seconds: the simulation is stopped, and its subprocesses terminated, once it is reached (in streaming mode the rows already simulated are written). Default is not set (no limit).')
+    parser.add_argument('--debug',action='store_true',default=False,help='debug mode, also showing the progress of the simulation (rows done, rows per second and estimated time to completion). Default is not set.')
     parser.add_argument('-v','--version',action='version',version='%(prog)s 0.5')
     try:
         args=parser.parse_args()
@@ -63,36 +130,138 @@ def main(argv=None):
     nodatav=args.noDataValue
     rotate_back=args.rotateBack
     n_subprocesses=args.subprocesses
+    engine=args.engine
+    backend=args.backend
+    streaming=args.streaming
+    strip_rows=args.stripRows
+    if args.serve is not None:
+        service=simulation_service(args.serveRunners,args.queueSize,n_subprocesses,engine,backend,args.heightEstimator,
+                                   int(args.imageCacheSize*2**20),args.cacheDir,int(args.cacheSize*2**20),debug_mode=debug_mode,
+                                   result_cache_dir=args.resultCacheDir,result_cache_bytes=int(args.resultCacheSize*2**20),
+                                   result_cache_link=args.resultCacheLink)
+        return STATE_OK if serve(args.serve,service)==0 else STATE_ERROR
+    if input_filename is None or output_filename is None:
+        print("ERROR: Input and output images are required.")
+        return STATE_ERROR
+    if not 0<args.heightSampleRate<=1:
+        print("ERROR: The height sample rate must be greater than 0 and not greater than 1.")
+        return STATE_ERROR
+
+    try:
+        configurations=parse_batch(args.batch,args.batchGrid)
+    except:
+        print("ERROR: Invalid batch configuration list.")
+        return STATE_ERROR
     
-    img=image(nodatav=nodatav)
+    prof=None
+    if args.profile is not None:
+        prof=profiler(profile_workers=args.profileWorkers)
+
+    def stage(name):
+        return contextlib.nullcontext() if prof is None else prof.stage(name)
+
+    #~ with the result cache, the input image is only loaded if the output is not cached
+    cached_result=args.resultCacheDir is not None and not args.preview and len(configurations)==0
+
+    deadline=None if args.timeout is None else time.time()+args.timeout
+
+    try:
+        img=image(nodatav=nodatav)
     
-    if img.read(input_filename)==0:
-        
-        if debug_mode:
-            ii=img.getImageInfo()
-            print("INFO: Input image size [pixels] and pixel spacing [m]: "+str(ii[0])+", "+str(ii[1]))
+        with stage('read'):
+            read=img.readInfo(input_filename) if streaming or args.preview or cached_result else img.read(input_filename)
+        if read==0:
         
-        sarsim=simulator(ia=incidence_angle,aa=aspect_angle,d=direction,img=img,opsize=(azimuth_pixel_spacing,slant_range_pixel_spacing),rb=rotate_back,sp=n_subprocesses,debug_mode=debug_mode)
+            if debug_mode:
+                ii=img.getImageInfo()
+                print("INFO: Input image size [pixels] and pixel spacing [m]: "+str(ii[0])+", "+str(ii[1]))
         
-        if sarsim.simulate()==0:
+            sarsim=simulator(ia=incidence_angle,aa=aspect_angle,d=direction,img=img,opsize=(azimuth_pixel_spacing,slant_range_pixel_spacing),rb=rotate_back,sp=n_subprocesses,debug_mode=debug_mode,engine=engine,backend=backend)
+            sarsim.profiler=prof
+            sarsim.deadline=deadline
             if debug_mode:
-                print("INFO: Simulation successful.")
-            if sarsim.getOutputImage().write(output_filename)==0:
-                if debug_mode:
-                    print("INFO: Output written.")
+                sarsim.progress_callback=print_progress
+            sarsim.oblique=args.oblique
+            sarsim.layers=args.layers
+            sarsim.output_type=args.outputType
+            sarsim.compression=args.compress
+            sarsim.overviews=args.overviews
+            sarsim.height_estimator=args.heightEstimator
+            sarsim.height_sample_rate=args.heightSampleRate
+            if args.cacheDir is not None:
+                sarsim.rotation_cache=rotation_cache(args.cacheDir,int(args.cacheSize*2**20))
+            if args.resultCacheDir is not None:
+                sarsim.result_cache=result_cache(args.resultCacheDir,int(args.resultCacheSize*2**20),args.resultCacheLink)
+            result_key=None
+            if cached_result:
+                with stage('hash'):
+                    result_key=sarsim.resultKey('streaming' if streaming else 'simulate')
+        
+            if args.preview:
+                if streaming or len(configurations)>0:
+                    print("ERROR: Preview mode is not supported in streaming and batch modes.")
+                elif sarsim.simulatePreview(args.previewLevel)==0:
+                    with stage('write'):
+                        written=sarsim.writePreviewImage(output_filename)
+                    if written==0:
+                        if debug_mode:
+                            print("INFO: Preview written.")
+                        return STATE_OK
+                    else:
+                        print("ERROR: Problem during output writing.")
+                else:
+                    print("ERROR: Problem during preview simulation.")
+            elif len(configurations)>0:
+                if streaming:
+                    print("ERROR: Batch mode is not supported in streaming mode.")
+                elif sarsim.simulateBatch(configurations,[batch_output_filename(output_filename,configuration) for configuration in configurations])==0:
+                    if debug_mode:
+                        print("INFO: Batch simulation successful, outputs written.")
+                    return STATE_OK
+                else:
+                    print("ERROR: Problem during batch simulation.")
+            elif result_key is not None and sarsim.fetchCachedResult(output_filename,result_key)==0:
                 return STATE_OK
+            elif streaming:
+                if sarsim.simulateStreaming(output_filename,strip_rows)==0:
+                    if debug_mode:
+                        print("INFO: Simulation successful, output written.")
+                    sarsim.storeResult(output_filename,result_key)
+                    return STATE_OK
+                else:
+                    print("ERROR: Problem during streaming simulation.")
             else:
-                print("ERROR: Problem during output writing.")            
+                if img.image is None:
+                    with stage('read'):
+                        read=sarsim.loadInputImage()
+                if read!=0:
+                    print("ERROR: Input image reading problem.")
+                elif sarsim.simulate()==0:
+                    if debug_mode:
+                        print("INFO: Simulation successful.")
+                    with stage('write'):
+                        written=sarsim.writeOutputImage(output_filename)
+                    if written==0:
+                        if debug_mode:
+                            print("INFO: Output written.")
+                        sarsim.storeResult(output_filename,result_key)
+                        return STATE_OK
+                    else:
+                        print("ERROR: Problem during output writing.")            
+                else:
+                    print("ERROR: Problem during simulation.")
         else:
-            print("ERROR: Problem during simulation.")
-    else:
-        print("ERROR: Input image reading problem.")
-    
+            print("ERROR: Input image reading problem.")
+    except KeyboardInterrupt:
+        #~ the subprocesses have already been terminated by the simulator
+        print("ERROR: Simulation interrupted.")
+    finally:
+        if prof is not None and prof.write(args.profile)!=0:
+            print("ERROR: Problem during profile writing.")
+
     return STATE_ERROR
 
     
     
 if __name__ == "__main__":
     sys.exit(main())
-
-
@@ -0,0 +1,80 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Synthetic DEMs used by the benchmarks. Each shape stresses one branch of sim_row:
+flat terrain (every position lit, no layover), a long ramp (long shadows), isolated tall
+buildings (full layover), stepped facades (cut layover) and nodata holed tiles. """
+
+
+import numpy
+
+from ..common.image import image
+
+
+def flat(size,h=100.,seed=0):
+    return numpy.full(size,h,dtype=numpy.float32)
+
+
+def ramp(size,slope=-0.9,seed=0):
+    """ Terrain descending away from the sensor, shadowed for its whole length at low incidence angles. """
+    rng=numpy.random.default_rng(seed)
+    x=numpy.arange(size[1])
+    dem=numpy.maximum(0.,slope*(x-size[1]))+numpy.zeros((size[0],1))
+    return (dem+rng.normal(0,0.1,size)).astype(numpy.float32)
+
+
+def buildings(size,n_buildings=None,footprint=8,h_max=60.,seed=0):
+    """ Flat ground with isolated tall blocks. """
+    rng=numpy.random.default_rng(seed)
+    dem=numpy.zeros(size,dtype=numpy.float32)
+    if n_buildings is None:
+        n_buildings=max(1,int(size[0]*size[1]/(20*footprint**2)))
+    for i_b in range(0,n_buildings):
+        y,x=rng.integers(0,max(1,size[0]-footprint)),rng.integers(0,max(1,size[1]-footprint))
+        dem[y:y+footprint,x:x+footprint]=rng.uniform(10.,h_max)
+    return dem
+
+
+def facades(size,step_width=7,step_height=4.,n_steps=9,seed=0):
+    """ Stepped facades, rising and falling along range, whose lower parts are shadowed by the previous steps. """
+    x=numpy.arange(size[1])
+    steps=(numpy.floor(x/step_width)%n_steps)*step_height
+    return (steps+numpy.zeros((size[0],1))).astype(numpy.float32)
+
+
+def holes(size,fraction=0.2,nodatav=-9999.,seed=0):
+    """ Rough terrain with randomly placed nodata holes. """
+    rng=numpy.random.default_rng(seed)
+    dem=rng.normal(50.,15.,size).astype(numpy.float32)
+    n_holes=max(1,int(fraction*size[0]*size[1]/64))
+    for i_h in range(0,n_holes):
+        y,x=rng.integers(0,size[0]),rng.integers(0,size[1])
+        dem[y:y+8,x:x+8]=nodatav
+    return dem
+
+
+generators={'flat':flat,'ramp':ramp,'buildings':buildings,'facades':facades,'holes':holes}
+
+
+def make_image(dem,pixel_size=(1.,1.),nodatav=-9999.):
+    """ Wraps a synthetic DEM into an image object, as if read from a GeoTIFF. """
+    img=image(nodatav=nodatav)
+    img.image=dem
+    img.size=dem.shape
+    img.pixel_size=pixel_size
+    return img
@@ -0,0 +1,203 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Benchmarks of the dSARsim hot paths (sim_row, image.rotate, calculateOutputImageOffset and the
+whole simulate) on synthetic DEMs. Results are returned as a JSON serializable dictionary. The output
+of each simulation is checked against the reference output of its case, simulated in the same run with
+the reference engine in this process; the reference outputs can also be checked against those stored by
+a previous run, e.g. of another release. """
+
+
+import os,sys,time,json,platform,itertools,tracemalloc
+import numpy
+
+from .. import simulator as sim
+from . import dems
+
+
+def timed(function,repeat=3):
+    """ Returns the best wall time [s] of repeat calls of function, and the result of the last call. """
+    best=None
+    result=None
+    for i_rep in range(0,repeat):
+        t0=time.perf_counter()
+        result=function()
+        t=time.perf_counter()-t0
+        best=t if best is None else min(best,t)
+    return best,result
+
+
+def case_name(kind,size,ia,aa,d):
+    return "%s_%dx%d_ia%g_aa%g_%s" % (kind,size[0],size[1],ia,aa,d)
+
+
+def bench_sim_row(dem,ia,engine,repeat=3,n_sample_rows=8):
+    """ Times one row engine on a sample of rows of the (not rotated) DEM. """
+    s=sim.simulator(ia=ia,img=dems.make_image(dem))
+    s.calculateOutputImageOffset()
+    rsp=s.row_sim_parameters
+    rows=numpy.linspace(0,dem.shape[0]-1,min(n_sample_rows,dem.shape[0])).astype(int)
+    sim_function=sim.row_engines[engine]
+    t,res=timed(lambda: [sim_function((dem[iY],rsp)) for iY in rows],repeat)
+    return {'rows':len(rows),'seconds':t,'rows_per_second':len(rows)/t if t>0 else None}
+
+
+def bench_rotate(dem,angle,repeat=3):
+    def rotate():
+        img=dems.make_image(dem).workingCopy()
+        img.rotate(angle,True,img.nodatav)
+        return img
+    t,img=timed(rotate,repeat)
+    return {'angle':angle,'seconds':t,'output_size':list(img.size)}
+
+
+def bench_offset(dem,ia,aa,d,repeat=3):
+    s=sim.simulator(ia=ia,aa=aa,d=d,img=dems.make_image(dem))
+    s._prepareWorkingImage()
+    def offset():
+        s.reference_height=None
+        s.resetOutputImage()
+        s.calculateOutputImageOffset()
+    t,res=timed(offset,repeat)
+    return {'seconds':t,'offset':s.row_sim_parameters.output_working_image_offset}
+
+
+def simulate_case(dem,ia,aa,d,engine,backend,n_subprocesses):
+    """ Returns the output image of one simulation of dem. """
+    s=sim.simulator(ia=ia,aa=aa,d=d,img=dems.make_image(dem),sp=n_subprocesses,engine=engine,backend=backend)
+    if s.simulate()!=0:
+        raise RuntimeError("simulation failed")
+    return s.getOutputImage().image
+
+
+def reference_output(dem,ia,aa,d):
+    """ Returns the reference output of a case: the reference engine simulating all the rows in this process
+    ('auto' backend with one subprocess). """
+    return simulate_case(dem,ia,aa,d,'reference','auto',1)
+
+
+def bench_simulate(dem,ia,aa,d,engine,backend,n_subprocesses,repeat=1,trace_memory=False):
+    def simulate():
+        return simulate_case(dem,ia,aa,d,engine,backend,n_subprocesses)
+    t,output=timed(simulate,repeat)
+    result={'engine':engine,'backend':backend,'n_subprocesses':n_subprocesses,'seconds':t,
+            'rows_per_second':dem.shape[0]/t if t>0 else None}
+    if trace_memory:
+        tracemalloc.start()
+        simulate()
+        result['peak_traced_memory_bytes']=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result,output
+
+
+def compare(output,reference):
+    """ Compares output with the reference output of its case. """
+    if reference.shape!=output.shape:
+        return {'status':'mismatch','reason':'shape','reference_shape':list(reference.shape),'shape':list(output.shape)}
+    n_diff=int(numpy.count_nonzero(reference!=output))
+    return {'status':'match' if n_diff==0 else 'mismatch','different_pixels':n_diff,
+            'max_abs_difference':float(numpy.abs(reference-output).max()) if output.size>0 else 0.}
+
+
+def check_stored_reference(reference,name,reference_dir,store):
+    """ Compares the reference output of the case with the one stored in reference_dir, storing it if missing and
+    store is set. """
+    if reference_dir is None:
+        return {'status':'not checked'}
+    filename=os.path.join(reference_dir,name+".npy")
+    if not os.path.exists(filename):
+        if store:
+            os.makedirs(reference_dir,exist_ok=True)
+            numpy.save(filename,reference)
+            return {'status':'stored'}
+        return {'status':'missing'}
+    return compare(reference,numpy.load(filename))
+
+
+def run(kinds=('flat','ramp','buildings','facades','holes'),sizes=((256,256),),incidence_angles=(30.,),aspect_angles=(0.,30.),
+        directions=('w',),engines=('reference','vectorized'),backends=('pool',),subprocesses=(1,),repeat=3,
+        reference_dir=None,store_references=False,trace_memory=False,log=None):
+    """ Runs the benchmark matrix and returns the results as a dictionary. """
+
+    results={'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),'python':platform.python_version(),
+             'numpy':numpy.__version__,'machine':platform.machine(),'cpu_count':os.cpu_count(),'cases':list()}
+
+    for kind,size in itertools.product(kinds,sizes):
+        dem=dems.generators[kind](tuple(size))
+        for ia,aa,d in itertools.product(incidence_angles,aspect_angles,directions):
+            name=case_name(kind,size,ia,aa,d)
+            if log is not None:
+                log("INFO: Benchmark case "+name+"...")
+            case={'name':name,'kind':kind,'size':list(size),'ia':ia,'aa':aa,'d':d}
+            case['sim_row']={engine:bench_sim_row(dem,ia,engine,repeat) for engine in engines}
+            rotation=(0 if d=='w' else -180)+aa
+            if rotation!=0:
+                case['rotate']=bench_rotate(dem,rotation,repeat)
+            case['offset']=bench_offset(dem,ia,aa,d,repeat)
+            reference=reference_output(dem,ia,aa,d)
+            case['stored_reference']=check_stored_reference(reference,name,reference_dir,store_references)
+            case['simulate']=list()
+            for engine,backend,n_subprocesses in itertools.product(engines,backends,subprocesses):
+                res,output=bench_simulate(dem,ia,aa,d,engine,backend,n_subprocesses,1,trace_memory)
+                res['reference']=compare(output,reference)
+                case['simulate'].append(res)
+            results['cases'].append(case)
+
+    return results
+
+
+def main(argv=None):
+    import argparse
+
+    def int_pair(text):
+        values=[int(v) for v in text.lower().split('x')]
+        return (values[0],values[-1])
+
+    parser=argparse.ArgumentParser(prog='python -m dsarsim.benchmark',description='Benchmarks dSARsim on synthetic DEMs.')
+    parser.add_argument('-o','--output',default=None,help='output JSON file. Default is standard output.')
+    parser.add_argument('--kinds',nargs='+',default=sorted(dems.generators.keys()),choices=sorted(dems.generators.keys()),help='synthetic DEMs. Default is all.')
+    parser.add_argument('--sizes',nargs='+',type=int_pair,default=[(256,256)],help="DEM sizes as ROWSxCOLUMNS. Default is 256x256.")
+    parser.add_argument('--incidenceAngles',nargs='+',type=float,default=[30.],help='incidence angles in degrees. Default is 30.')
+    parser.add_argument('--aspectAngles',nargs='+',type=float,default=[0.,30.],help='aspect angles in degrees. Default is 0 30.')
+    parser.add_argument('--directions',nargs='+',default=['w'],choices=['w','e'],help="viewing directions. Default is 'w'.")
+    parser.add_argument('--engines',nargs='+',default=sorted(sim.row_engines.keys()),choices=sorted(sim.row_engines.keys()),help='row engines. Default is all.')
+    parser.add_argument('--backends',nargs='+',default=['pool'],choices=sim.parallel_backends,help="parallel backends. Default is 'pool'.")
+    parser.add_argument('--subprocesses',nargs='+',type=int,default=[1],help='numbers of subprocesses. Default is 1.')
+    parser.add_argument('--repeat',type=int,default=3,help='repetitions of the single step timings (the best one is kept). Default is 3.')
+    parser.add_argument('--referenceDir',default=None,help='directory of the reference outputs stored by a previous run, with which the reference outputs of this run are compared. Default is not set (outputs are only compared with the reference outputs of this run).')
+    parser.add_argument('--storeReferences',default=False,action='store_true',help='store the missing reference outputs into the reference directory. Default is not set.')
+    parser.add_argument('--traceMemory',default=False,action='store_true',help='also measure the peak traced memory of each simulation (tracemalloc). Default is not set.')
+    parser.add_argument('--debug',action='store_true',default=False,help='debug mode. Default is not set.')
+    args=parser.parse_args(argv)
+
+    results=run(args.kinds,args.sizes,args.incidenceAngles,args.aspectAngles,args.directions,args.engines,args.backends,
+                args.subprocesses,args.repeat,args.referenceDir,args.storeReferences,args.traceMemory,print if args.debug else None)
+
+    text=json.dumps(results,indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output,'w') as f:
+            f.write(text)
+
+    mismatches=[case['name'] for case in results['cases'] for res in case['simulate'] if res['reference']['status']=='mismatch']
+    mismatches+=[case['name'] for case in results['cases'] if case['stored_reference']['status']=='mismatch']
+    if len(mismatches)>0:
+        print("ERROR: Output different from the reference in cases: "+", ".join(sorted(set(mismatches))),file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,308 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os,shutil,tempfile,hashlib,collections,threading,numpy
+
+
+def content_hash(array):
+    """ Hash of the content (values, shape and type) of a numpy array. """
+    return strips_hash(array.shape,[array])
+
+
+def strips_hash(shape,strips):
+    """ Hash of the content of an array of the given shape, given as consecutive strips of rows (e.g. read
+    by windows from a file); the same as content_hash of the whole array. """
+    h=None
+    for strip in strips:
+        if h is None:
+            h=hashlib.blake2b(digest_size=20)
+            h.update(str((tuple(shape),strip.dtype.str)).encode())
+        h.update(numpy.ascontiguousarray(strip).data)
+    return None if h is None else h.hexdigest()
+
+
+class rotation_cache:
+    """ Cache of rotated working images and of spline coefficients, stored as .npy files in a directory
+    and loaded as read-only memory maps. Rotated images are keyed by input content hash, rotation angle,
+    interpolation order and nodata value; spline coefficients, which do not depend on the angle, by input
+    content hash and interpolation order. The most recently used arrays are also kept in memory
+    (max_memory_items), while the files in the directory are evicted in least recently used order
+    when their total size exceeds max_bytes. """
+
+    def __init__(self,directory,max_bytes=4*2**30,max_memory_items=2):
+        self.directory=directory
+        self.max_bytes=max_bytes
+        self.max_memory_items=max_memory_items
+        self.memory=collections.OrderedDict()
+        os.makedirs(directory,exist_ok=True)
+
+
+    def rotationKey(self,source_hash,angle,order,nodatav):
+        return "rot_"+hashlib.sha1(repr((source_hash,float(angle),int(order),float(nodatav))).encode()).hexdigest()
+
+
+    def coefficientsKey(self,source_hash,order):
+        return "coef_"+hashlib.sha1(repr((source_hash,int(order))).encode()).hexdigest()
+
+
+    def get(self,key):
+        """ Returns the cached array, or None if key is not in the cache. """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self._touch(key)
+            return self.memory[key]
+        filename=self._filename(key)
+        try:
+            array=numpy.load(filename,mmap_mode='r')
+        except:
+            return None
+        self._touch(key)
+        self._remember(key,array)
+        return array
+
+
+    def put(self,key,array):
+        """ Stores array in the cache and returns its memory mapped copy. """
+        filename=self._filename(key)
+        #~ unique temporary file: several threads or processes can store the same key at once
+        tmp_filename=None
+        try:
+            fd,tmp_filename=tempfile.mkstemp(suffix=".tmp",dir=self.directory)
+            with os.fdopen(fd,'wb') as f:
+                numpy.save(f,array)
+            os.replace(tmp_filename,filename)
+        except:
+            if tmp_filename is not None and os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return array
+        self._evict(keep=filename)
+        cached=numpy.load(filename,mmap_mode='r')
+        self._remember(key,cached)
+        return cached
+
+
+    def clear(self):
+        self.memory.clear()
+        for filename in self._files():
+            os.remove(filename)
+
+
+    def _filename(self,key):
+        return os.path.join(self.directory,key+".npy")
+
+
+    def _files(self):
+        return [os.path.join(self.directory,f) for f in os.listdir(self.directory) if f.endswith(".npy")]
+
+
+    def _touch(self,key):
+        try:
+            os.utime(self._filename(key))
+        except OSError:
+            pass
+
+
+    def _remember(self,key,array):
+        self.memory[key]=array
+        self.memory.move_to_end(key)
+        while len(self.memory)>self.max_memory_items:
+            self.memory.popitem(last=False)
+
+
+    def _evict(self,keep=None):
+        """ Removes the least recently used files until the cache size is below max_bytes. """
+        files=list()
+        for filename in self._files():
+            try:
+                st=os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime,st.st_size,filename))
+        files.sort()
+        total=sum(f[1] for f in files)
+        for mtime,size,filename in files:
+            if total<=self.max_bytes:
+                break
+            if filename==keep:
+                continue
+            key=os.path.basename(filename)[:-4]
+            self.memory.pop(key,None)
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total-=size
+
+
+class image_cache:
+    """ In memory cache of input images read from files, shared by the simulations of a long running process
+    (see service.simulation_service). Images are keyed by file path, modification time, size and nodata value,
+    so that a file changed on disk is read again; the least recently used images are dropped when the total size
+    of the cached data exceeds max_bytes. Cached images are shared and must not be modified: the simulator only
+    works on working copies of its input image. """
+
+    def __init__(self,max_bytes=2*2**30):
+        self.max_bytes=max_bytes
+        self.images=collections.OrderedDict()
+        self.lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+
+
+    def get(self,filename,nodatav):
+        """ Returns the image read from filename (see image.read), or None if it cannot be read. """
+        from .image import image
+
+        try:
+            st=os.stat(filename)
+        except OSError:
+            return None
+        key=(os.path.realpath(filename),st.st_mtime_ns,st.st_size,float(nodatav))
+
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.hits+=1
+                return self.images[key]
+            self.misses+=1
+
+        img=image(nodatav=nodatav)
+        if img.read(filename)!=0:
+            return None
+
+        with self.lock:
+            self.images[key]=img
+            self.images.move_to_end(key)
+            total=sum(cached.image.nbytes for cached in self.images.values())
+            while total>self.max_bytes and len(self.images)>1:
+                old_key,old=self.images.popitem(last=False)
+                total-=old.image.nbytes
+        return img
+
+
+    def info(self):
+        with self.lock:
+            return {'images':len(self.images),'bytes':sum(img.image.nbytes for img in self.images.values()),
+                    'hits':self.hits,'misses':self.misses}
+
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+
+
+class result_cache:
+    """ Cache of simulation results: output files stored in a directory under the key of the simulation (see
+    simulator.resultKey, a hash of the input image content and of every parameter affecting the output file).
+    A cached result is served by copying the stored file to the requested output file or, if link is set, by
+    hard linking it (no copy at all; files are then shared, so the output file should not be modified in place).
+    The least recently served or stored files are evicted when the total size of the cache exceeds max_bytes. """
+
+    def __init__(self,directory,max_bytes=4*2**30,link=False):
+        self.directory=directory
+        self.max_bytes=max_bytes
+        self.link=link
+        os.makedirs(directory,exist_ok=True)
+
+
+    def get(self,key,filename):
+        """ Writes the result stored under key to filename. Returns 0 on success, -1 if key is not in the cache. """
+        cached=self._filename(key)
+        if not os.path.exists(cached):
+            return -1
+        try:
+            if os.path.lexists(filename):
+                os.remove(filename)
+            self._transfer(cached,filename)
+        except OSError:
+            return -1
+        self._touch(cached)
+        return 0
+
+
+    def put(self,key,filename):
+        """ Stores the output file filename under key. Returns 0 on success, -1 otherwise. """
+        cached=self._filename(key)
+        #~ unique temporary directory: several threads or processes can store the same key at once, and the
+        #~ temporary file must not exist yet to be hard linked
+        tmp_directory=None
+        try:
+            tmp_directory=tempfile.mkdtemp(suffix=".tmp",dir=self.directory)
+            tmp_filename=os.path.join(tmp_directory,key+".tif")
+            self._transfer(filename,tmp_filename)
+            os.replace(tmp_filename,cached)
+        except OSError:
+            return -1
+        finally:
+            if tmp_directory is not None:
+                shutil.rmtree(tmp_directory,ignore_errors=True)
+        self._evict(keep=cached)
+        return 0
+
+
+    def clear(self):
+        for filename in self._files():
+            os.remove(filename)
+
+
+    def _transfer(self,source,destination):
+        if self.link:
+            try:
+                os.link(source,destination)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source,destination)
+
+
+    def _filename(self,key):
+        return os.path.join(self.directory,key+".tif")
+
+
+    def _files(self):
+        return [os.path.join(self.directory,f) for f in os.listdir(self.directory) if f.endswith(".tif")]
+
+
+    def _touch(self,filename):
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+
+    def _evict(self,keep=None):
+        """ Removes the least recently used files until the cache size is below max_bytes. """
+        files=list()
+        for filename in self._files():
+            try:
+                st=os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime,st.st_size,filename))
+        files.sort()
+        total=sum(f[1] for f in files)
+        for mtime,size,filename in files:
+            if total<=self.max_bytes:
+                break
+            if filename==keep:
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total-=size
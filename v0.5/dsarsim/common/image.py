@@ -16,8 +16,78 @@
 #   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
 
 
-import sys,numpy,scipy.ndimage
+import os,sys,numpy,scipy.ndimage,scipy.special
 from osgeo import gdal
+from .cache import content_hash,strips_hash
+
+
+def rotation_geometry(shape,angle,rshp):
+    """ Returns the matrix, the offset and the output shape of the affine transform applied by
+    image.rotate (i.e. by scipy.ndimage.rotate) to an image of the given shape. Input coordinates
+    are obtained from output ones as matrix.dot(output)+offset. """
+
+    c,s=scipy.special.cosdg(angle),scipy.special.sindg(angle)
+    rot_matrix=numpy.array([[c,s],[-s,c]])
+    in_shape=numpy.asarray(shape[:2])
+    if rshp:
+        out_bounds=rot_matrix.dot([[0,0,in_shape[0],in_shape[0]],[0,in_shape[1],0,in_shape[1]]])
+        out_shape=(numpy.ptp(out_bounds,axis=1)+0.5).astype(int)
+    else:
+        out_shape=in_shape
+    offset=(in_shape-1)/2.-rot_matrix.dot((out_shape-1)/2.)
+    return rot_matrix,offset,(int(out_shape[0]),int(out_shape[1]))
+
+
+def trace_extents(rot_matrix,offset,shape,rows,cols):
+    """ Returns the first and last + 1 columns, between cols[0] and cols[1], of the lines traced for the given rows of
+    the working image (see rotation_geometry and image.traceWindow) whose nearest input pixel is inside an image of
+    the given shape. The extents may include one or two more columns at each end, to be checked on the pixels. """
+    first=numpy.full(rows.shape,float(cols[0]))
+    last=numpy.full(rows.shape,float(cols[1]))
+    for k in range(0,2):
+        #~ input coordinate k along the line: step*column+start, inside for -0.5 <= value < shape[k]-0.5
+        step,start=rot_matrix[k,1],rot_matrix[k,0]*rows+offset[k]
+        if abs(step)<1e-12:
+            outside=(start<-0.5)|(start>=shape[k]-0.5)
+            last[outside]=first[outside]
+            continue
+        bounds=((-0.5-start)/step,(shape[k]-0.5-start)/step)
+        first=numpy.maximum(first,numpy.minimum(*bounds)-1)
+        last=numpy.minimum(last,numpy.maximum(*bounds)+2)
+    first=numpy.floor(first).astype(numpy.int64)
+    last=numpy.ceil(last).astype(numpy.int64)
+    return first,numpy.maximum(first,last)
+
+
+def zoom_geometry(shape,scale_factors):
+    """ Returns the zoom factors (input coordinates = zoom*output coordinates) and the output shape
+    of image.resize (i.e. of scipy.ndimage.zoom) applied to an image of the given shape. """
+
+    out_shape=tuple([int(round(shape[i]*scale_factors[i])) for i in range(0,2)])
+    zoom=[(shape[i]-1)/(out_shape[i]-1) if out_shape[i]>1 else 1. for i in range(0,2)]
+    return zoom,out_shape
+
+
+#~ GDAL data types of the numpy types used for writing
+gdal_types={numpy.dtype(numpy.uint8):gdal.GDT_Byte,numpy.dtype(numpy.uint16):gdal.GDT_UInt16,numpy.dtype(numpy.int16):gdal.GDT_Int16,
+            numpy.dtype(numpy.uint32):gdal.GDT_UInt32,numpy.dtype(numpy.int32):gdal.GDT_Int32,numpy.dtype(numpy.float32):gdal.GDT_Float32}
+
+
+def compact_type(min_value,max_value):
+    """ Returns the smallest integer numpy type holding all the integers between min_value and max_value. """
+    for t in ((numpy.uint8,numpy.uint16,numpy.uint32) if min_value>=0 else (numpy.int16,numpy.int32)):
+        if numpy.iinfo(t).min<=min_value and max_value<=numpy.iinfo(t).max:
+            return numpy.dtype(t)
+    return numpy.dtype(numpy.float32)
+
+
+def _gdal_nodata_consistent(band,nodatav):
+    """ True if GDAL statistics and overviews of band are not affected by nodatav, i.e. if nodatav is the nodata
+    value of the band or is not present in it. """
+    if band.GetNoDataValue()==nodatav:
+        return True
+    v_min,v_max=band.ComputeRasterMinMax(True)
+    return not v_min<=nodatav<=v_max
 
 
 class image:
@@ -32,7 +102,16 @@ class image:
         self.matrix_type=numpy.float32
         self.file_type=gdal.GDT_Float32
 
+        #~ GeoTIFF creation parameters used by write and create
+        self.compression=None           #~ e.g. 'DEFLATE', 'ZSTD' or 'LZW' (the file is then also tiled), None = not compressed
+        self.tile_size=None             #~ tile size in pixels, None = striped file (256 if compressed)
+        self.overviews=False            #~ if True, overviews are built when the file is written or closed
+        self.overview_resampling='NEAREST'
+
         self.image=None
+        self.filename=None
+        self.source_filename=None       #~ file the image data was read from, used for GDAL statistics (see gdalHistogram)
+        self.dataset=None
         self.size=size
         self.pixel_size=ps
         self.nodatav=nodatav
@@ -46,13 +125,43 @@ class image:
 
                 
     def empty(self,value=0):
-        self.image=numpy.ones(self.size,dtype=self.matrix_type)*value
+        if value==0:
+            self.image=numpy.zeros(self.size,dtype=self.matrix_type)
+        else:
+            self.image=numpy.full(self.size,value,dtype=self.matrix_type)
+
+
+    def workingCopy(self):
+        """ Returns a copy of the image object sharing the image data (copy-on-write): all the transformation
+        methods (rotate, transform, flip, crop, resize) replace the data instead of modifying it, so a new
+        array is materialized only when one of them is actually applied to the copy. """
+        img=image(self.size,self.pixel_size,nodatav=self.nodatav)
+        img.matrix_type=self.matrix_type
+        img.file_type=self.file_type
+        img.image=self.image
+        img.filename=self.filename
+        return img
+
+
+    def setFileType(self,dtype):
+        """ Sets the data type used in the files written by write and create (a numpy type, see gdal_types). """
+        self.file_type=gdal_types[numpy.dtype(dtype)]
+
+
+    def fileType(self):
+        """ Returns the data type used in the files written by write and create, as a numpy type. """
+        return [t for t,gdal_type in gdal_types.items() if gdal_type==self.file_type][0]
 
         
-    def rotate(self,angle,rshp,nodatav,order=3):
+    def rotate(self,angle,rshp,nodatav,order=3,coefficients=None):
         #~ angle > 0 means counterclockwise rotation
+        #~ coefficients, if given, are the spline coefficients of the image (see splineCoefficients), which are then not computed again
         try:
-            tmp_img=scipy.ndimage.interpolation.rotate(self.image, angle, axes=(1, 0), reshape=rshp, output=None, order=order, mode='constant', cval=nodatav, prefilter=True)
+            if coefficients is None:
+                tmp_img=scipy.ndimage.interpolation.rotate(self.image, angle, axes=(1, 0), reshape=rshp, output=None, order=order, mode='constant', cval=nodatav, prefilter=True)
+            else:
+                rot_matrix,offset,out_shape=rotation_geometry(self.size,angle,rshp)
+                tmp_img=scipy.ndimage.affine_transform(coefficients, rot_matrix, offset, out_shape, output=self.image.dtype, order=order, mode='constant', cval=nodatav, prefilter=False)
         except:
             return -1
         self.image=tmp_img
@@ -60,6 +169,29 @@ class image:
         return 0
         
         
+    def splineCoefficients(self,order=3):
+        """ Returns the spline coefficients used by rotate to interpolate the image with the given order. """
+        return scipy.ndimage.spline_filter(self.image, order, output=numpy.float64, mode='constant')
+
+
+    def transform(self,matrix,offset,size,order,cval=0):
+        """ Applies a generic affine transform (input coordinates = matrix.dot(output)+offset), computing
+        only an output image of the given size. """
+        try:
+            tmp_img=scipy.ndimage.affine_transform(self.image, matrix, offset, size, output=self.image.dtype, order=order, mode='constant', cval=cval, prefilter=False)
+        except:
+            return -1
+        self.image=tmp_img
+        self.size=self.image.shape
+        return 0
+
+
+    def flip(self):
+        """ Rotates the image by 180 degrees as a view of the current data, with no copy. """
+        self.image=self.image[::-1,::-1]
+        return 0
+
+
     def crop(self,tl_corner,size):
         try:
             tmp_img=self.image[tl_corner[0]:tl_corner[0]+size[0],tl_corner[1]:tl_corner[1]+size[1]]
@@ -81,29 +213,170 @@ class image:
         return 0
         
 
-    def write(self,filename):
+    def downsample(self,factor,nodatav,strip_rows=256):
+        """ Returns a new image reduced by an integer factor: each pixel is the mean of the valid (not nodatav)
+        pixels of a factor x factor block, or nodatav if the block has none, and the pixel size is multiplied by
+        factor. The image is processed by strips of strip_rows output rows, read from the file set by readInfo if
+        the data is not in memory. """
+        size=(-(-self.size[0]//factor),-(-self.size[1]//factor))
+        img=image(size,(self.pixel_size[0]*factor,self.pixel_size[1]*factor),nodatav=self.nodatav)
+        img.matrix_type=self.matrix_type
+        img.file_type=self.file_type
+        img.image=numpy.empty(size,dtype=self.matrix_type)
+        try:
+            for iY in range(0,size[0],strip_rows):
+                rows=min(strip_rows,size[0]-iY)
+                if self.image is None:
+                    strip=self.readWindow((iY*factor,0),(rows*factor,size[1]*factor))
+                else:
+                    strip=numpy.full((rows*factor,size[1]*factor),nodatav,dtype=self.matrix_type)
+                    src=self.image[iY*factor:(iY+rows)*factor]
+                    strip[:src.shape[0],:src.shape[1]]=src
+                blocks=strip.reshape(rows,factor,size[1],factor)
+                valid=blocks!=nodatav
+                count=valid.sum(axis=(1,3))
+                total=numpy.where(valid,blocks,0).sum(axis=(1,3),dtype=numpy.float64)
+                img.image[iY:iY+rows]=numpy.where(count>0,total/numpy.maximum(count,1),nodatav)
+        except:
+            return None
+        return img
+
+
+    def readOverview(self,factor,nodatav):
+        """ Returns the GDAL overview of the file the image was read from which is reduced by factor, as a new
+        image with the pixel size multiplied by factor, or None if the file has no such overview or if nodatav
+        is present in the file without being its nodata value (overview resampling would mix it with the heights). """
+        if self.source_filename is None:
+            return None
+        size=(-(-self.size[0]//factor),-(-self.size[1]//factor))
+        try:
+            band=gdal.Open(self.source_filename).GetRasterBand(1)
+            if not _gdal_nodata_consistent(band,nodatav):
+                return None
+            for i_ov in range(0,band.GetOverviewCount()):
+                ov=band.GetOverview(i_ov)
+                if (ov.YSize,ov.XSize)==size:
+                    img=image(size,(self.pixel_size[0]*factor,self.pixel_size[1]*factor),nodatav=self.nodatav)
+                    img.image=ov.ReadAsArray().astype(self.matrix_type,copy=False)
+                    return img
+        except:
+            return None
+        return None
+
+
+    def write(self,filename,bands=None,band_names=None,strip_rows=1024):
+        """ Writes the image to a GeoTIFF file. bands is an optional list of arrays of the same size of the image,
+        written as further bands; band_names, if given, are set as descriptions of all the bands. Data are converted
+        to the file type and written by strips of strip_rows rows. """
         if self.size[0]==0 or self.size[1]==0:
             return -1
       
+        if bands is None:
+            bands=list()
         try:
-            driver = gdal.GetDriverByName('GTiff')
+            ds = self._createDataset(filename,1+len(bands),band_names)
+            for i_band,data in enumerate([self.image]+list(bands)):
+                b = ds.GetRasterBand(i_band+1)
+                for iY in range(0,self.size[0],strip_rows):
+                    b.WriteArray(self._fileData(data[iY:iY+strip_rows]),0,iY)
+            self._buildOverviews(ds)
+            ds.FlushCache()  # write to disk.
+        except:
+            return -1
+        return 0
 
-            ds = driver.Create(filename,self.size[1],self.size[0],1,self.file_type)
 
-            ds.SetGeoTransform((
-                0,                      # 0: x_min
-                self.pixel_size[1],     # 1: pixel_size_x
-                0,                      # 2: 0
-                self.size[0],           # 3: y_max
-                0,                      # 4: 0
-                -self.pixel_size[0]))   # 5: -pixel_size_y
+    def create(self,filename,n_bands=1,band_names=None):
+        """ Creates an empty GeoTIFF image of the current size and pixel size, with n_bands bands, to be filled
+        incrementally with writeWindow and finalized with close. """
+        if self.size[0]==0 or self.size[1]==0:
+            return -1
 
-            ds.GetRasterBand(1).WriteArray(self.image)
-            ds.FlushCache()  # write to disk.
+        try:
+            self.dataset = self._createDataset(filename,n_bands,band_names)
+        except:
+            return -1
+        return 0
+
+
+    def writeWindow(self,data,tl_corner,band=1):
+        """ Writes data into the given band of the image created with create, starting at tl_corner (row, column). """
+        try:
+            self.dataset.GetRasterBand(band).WriteArray(self._fileData(data),int(tl_corner[1]),int(tl_corner[0]))
         except:
             return -1
         return 0
 
+
+    def close(self):
+        if self.dataset is not None:
+            try:
+                self._buildOverviews(self.dataset)
+                self.dataset.FlushCache()  # write to disk.
+            except:
+                return -1
+            finally:
+                self.dataset=None
+        return 0
+
+
+    def _fileData(self,data):
+        """ Returns data converted to the file type; values out of the range of an integer file type are clipped. """
+        dtype=self.fileType()
+        data=numpy.asarray(data)
+        if dtype.kind!='f' and data.dtype!=dtype and data.size>0:
+            data=numpy.clip(data,numpy.iinfo(dtype).min,numpy.iinfo(dtype).max)
+        return numpy.asarray(data,dtype=dtype)
+
+
+    def _creationOptions(self,n_bands):
+        """ GeoTIFF creation options: tiling, compression with the predictor suited to the file type, and BigTIFF
+        when the uncompressed data could exceed the 4 GB limit of classic TIFF files. """
+        options=list()
+        tile_size=self.tile_size
+        if tile_size is None and self.compression is not None:
+            tile_size=256
+        if tile_size is not None:
+            options+=['TILED=YES','BLOCKXSIZE='+str(tile_size),'BLOCKYSIZE='+str(tile_size)]
+        if self.compression is not None:
+            options+=['COMPRESS='+self.compression,'PREDICTOR='+('3' if self.file_type==gdal.GDT_Float32 else '2')]
+        n_bytes=self.size[0]*self.size[1]*n_bands*self._fileData(numpy.zeros((0,))).itemsize
+        options.append('BIGTIFF='+('YES' if n_bytes>=0.9*2**32 else 'IF_SAFER'))
+        return options
+
+
+    def _buildOverviews(self,ds):
+        if self.overviews:
+            factors=list()
+            factor=2
+            while max(self.size)/factor>=256:
+                factors.append(factor)
+                factor*=2
+            if len(factors)>0:
+                ds.BuildOverviews(self.overview_resampling,factors)
+
+
+    def _createDataset(self,filename,n_bands=1,band_names=None):
+        driver = gdal.GetDriverByName('GTiff')
+
+        #~ an existing file is replaced, not overwritten in place: it could be a hard link to a cached result (see common.cache.result_cache)
+        if os.path.lexists(filename):
+            os.remove(filename)
+
+        ds = driver.Create(filename,self.size[1],self.size[0],n_bands,self.file_type,options=self._creationOptions(n_bands))
+        if band_names is not None:
+            for i_band in range(0,n_bands):
+                ds.GetRasterBand(i_band+1).SetDescription(band_names[i_band])
+
+        ds.SetGeoTransform((
+            0,                      # 0: x_min
+            self.pixel_size[1],     # 1: pixel_size_x
+            0,                      # 2: 0
+            self.size[0],           # 3: y_max
+            0,                      # 4: 0
+            -self.pixel_size[0]))   # 5: -pixel_size_y
+        return ds
+
         
     def read(self,filename):
         try:
@@ -115,4 +388,157 @@ class image:
             self.pixel_size = (-gt[5],gt[1])
         except:
             return -1
+        self.source_filename = filename
         return 0
+
+
+    def readInfo(self,filename):
+        """ Reads only size and pixel spacing of a GeoTIFF image. The image data is left on disk
+        and can be read by windows with readWindow and readRotatedWindow. """
+        try:
+            ds = gdal.Open(filename)
+            self.size = (ds.RasterYSize,ds.RasterXSize)
+            gt = ds.GetGeoTransform()
+            self.pixel_size = (-gt[5],gt[1])
+        except:
+            return -1
+        self.image = None
+        self.filename = filename
+        self.source_filename = filename
+        return 0
+
+
+    def readWindow(self,tl_corner,size):
+        """ Returns the window of the image starting at tl_corner (row, column) and having the given size, taken
+        from the image data if in memory, otherwise from the image file set by readInfo. The parts of the window
+        outside the image are set to nodatav. """
+        window=numpy.full(size,self.nodatav,dtype=self.matrix_type)
+        y0,x0=max(0,tl_corner[0]),max(0,tl_corner[1])
+        y1,x1=min(self.size[0],tl_corner[0]+size[0]),min(self.size[1],tl_corner[1]+size[1])
+        if y1>y0 and x1>x0 and self.image is not None:
+            window[y0-tl_corner[0]:y1-tl_corner[0],x0-tl_corner[1]:x1-tl_corner[1]]=self.image[y0:y1,x0:x1]
+        elif y1>y0 and x1>x0:
+            ds = gdal.Open(self.filename)
+            window[y0-tl_corner[0]:y1-tl_corner[0],x0-tl_corner[1]:x1-tl_corner[1]]=ds.GetRasterBand(1).ReadAsArray(x0,y0,x1-x0,y1-y0)
+        return window
+
+
+    def contentHash(self,strip_rows=1024):
+        """ Returns the hash of the image data and of its type (see common.cache.content_hash), or None if the data
+        cannot be read. If the data is not in memory, it is read by strips of strip_rows rows from the file set by
+        readInfo, in the data type of the file, as read would load it: the hash does not depend on how the image
+        was loaded. """
+        if self.image is not None:
+            return content_hash(self.image)
+        try:
+            band=gdal.Open(self.filename).GetRasterBand(1)
+            return strips_hash(self.size,(band.ReadAsArray(0,iY,self.size[1],min(strip_rows,self.size[0]-iY)) for iY in range(0,self.size[0],strip_rows)))
+        except:
+            return None
+
+
+    def histogram(self,n_bins,nodatav,step=1,strip_rows=1024):
+        """ Returns the histogram of the valid (not nodatav) pixel values and its bin edges, as given by
+        numpy.histogram(values,n_bins). The image is processed by strips of strip_rows rows, read from the file
+        set by readInfo if the data is not in memory, so that no full size temporary array is allocated.
+        If step>1, only one pixel every step rows and step columns is taken into account. """
+        def valid_strips():
+            for iY in range(0,self.size[0],strip_rows*step):
+                rows=min(strip_rows*step,self.size[0]-iY)
+                if self.image is None:
+                    strip=self.readWindow((iY,0),(rows,self.size[1]))[::step,::step]
+                else:
+                    strip=self.image[iY:iY+rows:step,::step]
+                yield strip[strip!=nodatav]
+
+        v_min,v_max,empty=None,None,None
+        for values in valid_strips():
+            empty=values[:0]
+            if values.size>0:
+                v_min=values.min() if v_min is None else min(v_min,values.min())
+                v_max=values.max() if v_max is None else max(v_max,values.max())
+        if v_min is None:
+            return numpy.histogram(numpy.zeros((0,),dtype=self.matrix_type if empty is None else empty.dtype),n_bins)
+
+        hist=numpy.zeros((n_bins,),dtype=numpy.int64)
+        for values in valid_strips():
+            hist+=numpy.histogram(values,n_bins,(v_min,v_max))[0]
+        return hist,numpy.histogram_bin_edges(empty,n_bins,(v_min,v_max))
+
+
+    def gdalHistogram(self,n_bins,nodatav):
+        """ Returns the histogram of the valid pixel values and its bin edges as computed by GDAL on the file
+        the image was read from. Approximate results are accepted, so GDAL uses the overviews of the file, if any,
+        or a subsample of it. Returns None if not available, i.e. if the image was not read from a file or if
+        nodatav is present in the file without being its nodata value. """
+        if self.source_filename is None:
+            return None
+        try:
+            band=gdal.Open(self.source_filename).GetRasterBand(1)
+            if not _gdal_nodata_consistent(band,nodatav):
+                return None
+            v_min,v_max=band.ComputeRasterMinMax(True)
+            hist=band.GetHistogram(v_min,v_max,n_bins,include_out_of_range=1,approx_ok=1)
+        except:
+            return None
+        return numpy.array(hist,dtype=numpy.int64),numpy.linspace(v_min,v_max,n_bins+1)
+
+
+    def traceWindow(self,angle,nodatav,tl_corner,size,strip_rows=128):
+        """ Returns a window of the image (see readWindow) in the geometry given by rotate(angle,True,nodatav),
+        without interpolating it: each row of the window is traced through the image as a line along the rotated
+        columns direction, starting from the position of its first pixel (given by its row, i.e. the azimuth index)
+        with a fixed step per column, and each pixel takes the height of the nearest image pixel. Heights are thus
+        never blurred, nodata does not spread and no spline coefficients are computed. Only the valid extent of
+        each line, i.e. the columns falling inside the image, is sampled; the rest of the window is nodata. The
+        window is traced by strips of strip_rows rows; for each strip only the bounding box of the sampled pixels
+        is read. """
+        rot_matrix,offset,rsize=rotation_geometry(self.size,angle,True)
+        window=numpy.full(size,nodatav,dtype=self.matrix_type)
+        for y_strip in range(0,size[0],strip_rows):
+            rows=numpy.arange(tl_corner[0]+y_strip,tl_corner[0]+min(size[0],y_strip+strip_rows),dtype=numpy.float64)
+            first,last=trace_extents(rot_matrix,offset,self.size,rows,(tl_corner[1],tl_corner[1]+size[1]))
+            lengths=numpy.maximum(last-first,0)
+            n_samples=int(lengths.sum())
+            if n_samples==0:
+                continue
+            #~ line and column of every sample of the valid extents, in window coordinates
+            line=numpy.repeat(numpy.arange(rows.shape[0]),lengths)
+            col=numpy.arange(n_samples)-numpy.repeat(numpy.cumsum(lengths)-lengths-(first-tl_corner[1]),lengths)
+            y,x=rows[line],col+float(tl_corner[1])
+            #~ line start (from the azimuth index) plus the column step along the line, rounded to the nearest pixel
+            iy=numpy.floor(rot_matrix[0,0]*y+offset[0]+rot_matrix[0,1]*x+0.5).astype(numpy.int64)
+            ix=numpy.floor(rot_matrix[1,0]*y+offset[1]+rot_matrix[1,1]*x+0.5).astype(numpy.int64)
+            inside=(iy>=0)&(iy<self.size[0])&(ix>=0)&(ix<self.size[1])
+            if not inside.any():
+                continue
+            line,col,iy,ix=line[inside],col[inside],iy[inside],ix[inside]
+            if self.image is not None:
+                y0,x0,src=0,0,self.image
+            else:
+                y0,x0=int(iy.min()),int(ix.min())
+                src=self.readWindow((y0,x0),(int(iy.max())+1-y0,int(ix.max())+1-x0))
+            window[y_strip+line,col]=src[iy-y0,ix-x0]
+        return window
+
+
+    def readRotatedWindow(self,angle,nodatav,tl_corner,size,order=3,margin=16,tile_cols=512):
+        """ Returns a window of the image (see readWindow) as it would be after rotate(angle,True,nodatav,order),
+        without rotating (nor reading) the whole image. The window is processed in tiles of tile_cols columns:
+        for each tile only the bounding box of the corresponding input area, enlarged by margin pixels, is read
+        and interpolated. The spline prefilter is thus computed on the tile bounding box instead of the whole
+        image: with the default margin the difference with respect to rotate is below 1e-6 times the height range. """
+        rot_matrix,offset,rsize=rotation_geometry(self.size,angle,True)
+        window=numpy.full(size,nodatav,dtype=self.matrix_type)
+        for x_tile in range(0,size[1],tile_cols):
+            cols=min(tile_cols,size[1]-x_tile)
+            oy,ox=numpy.mgrid[tl_corner[0]:tl_corner[0]+size[0],tl_corner[1]+x_tile:tl_corner[1]+x_tile+cols]
+            iy=rot_matrix[0,0]*oy+rot_matrix[0,1]*ox+offset[0]
+            ix=rot_matrix[1,0]*oy+rot_matrix[1,1]*ox+offset[1]
+            y0,x0=max(0,int(numpy.floor(iy.min()))-margin),max(0,int(numpy.floor(ix.min()))-margin)
+            y1,x1=min(self.size[0],int(numpy.ceil(iy.max()))+margin+1),min(self.size[1],int(numpy.ceil(ix.max()))+margin+1)
+            if y1<=y0 or x1<=x0:
+                continue
+            src=self.readWindow((y0,x0),(y1-y0,x1-x0))
+            window[:,x_tile:x_tile+cols]=scipy.ndimage.map_coordinates(src,[iy-y0,ix-x0],output=self.matrix_type,order=order,mode='constant',cval=nodatav,prefilter=True)
+        return window
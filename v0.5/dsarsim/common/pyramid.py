@@ -0,0 +1,58 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+class pyramid:
+    """ Pyramid of reduced resolution versions of a DTM/DSM image, used for quick previews of the simulation.
+    Level 0 is the image itself and level l is reduced by 2**l, with the pixel size multiplied accordingly.
+    Levels are built on first use and kept: they are read from the GDAL overviews of the input file when
+    available (see image.readOverview), otherwise computed by block averaging of the previous level. The input
+    image can also be an image set with image.readInfo, whose data is still on disk: only the first level is
+    then computed from the file, by strips, and level 0 is read entirely only if it is asked for. """
+
+    def __init__(self,img,nodatav):
+        self.nodatav=nodatav
+        self.levels=[img]
+
+
+    def getLevel(self,level):
+        """ Returns the image of the given level, or None if it cannot be built. """
+        if level==0 and self.levels[0].image is None:
+            img=self.levels[0].workingCopy()
+            try:
+                img.image=self.levels[0].readWindow((0,0),img.size)
+            except:
+                return None
+            img.source_filename=self.levels[0].source_filename
+            self.levels[0]=img
+        while len(self.levels)<=level:
+            img=self.levels[0].readOverview(2**len(self.levels),self.nodatav)
+            if img is None:
+                img=self.levels[-1].downsample(2,self.nodatav)
+            if img is None:
+                return None
+            self.levels.append(img)
+        return self.levels[level]
+
+
+    def levelForSize(self,max_pixels):
+        """ Returns the first level having at most max_pixels pixels (and at least 2 pixels per side). """
+        size=self.levels[0].size
+        level=0
+        while size[0]*size[1]>max_pixels*4**level and min(size)>=2**(level+2):
+            level+=1
+        return level
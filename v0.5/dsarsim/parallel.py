@@ -0,0 +1,369 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os,time,threading,weakref
+import numpy
+
+
+#~ shared memory blocks attached by each worker process, by name
+_attached=dict()
+
+#~ arrays created by shared_array, by id: (weak reference to the array, shared memory block name)
+_shared_arrays=dict()
+
+
+def row_blocks(n_rows,block_rows):
+    """ Splits n_rows rows into contiguous (first row, last row + 1) blocks of block_rows rows. """
+    return [(iY,min(iY+block_rows,n_rows)) for iY in range(0,n_rows,block_rows)]
+
+
+def default_block_rows(n_rows,n_workers):
+    """ Block size giving about four blocks per worker, which keeps the load balanced
+    without sending too many tasks. """
+    return max(1,int(n_rows/(4*max(1,n_workers))))
+
+
+def sim_block(input_array,output_array,block,rsp,sim_function,stop=None):
+    """ Simulates the rows of one block of the input working image, writing the results
+    directly into the corresponding rows of the output working image (of each layer, if
+    output_array has one more leading dimension, see simulator.working_layers). If stop
+    (e.g. a threading.Event) is given, the block is left as soon as it is set. Returns
+    the number of rows simulated. """
+    for iY in range(block[0],block[1]):
+        if stop is not None and stop.is_set():
+            return iY-block[0]
+        sim_function((input_array[iY],rsp),output_array[...,iY,:])
+    return block[1]-block[0]
+
+
+class chunk_function:
+    """ Picklable wrapper of a function run by the worker processes on chunks of consecutive items: a task is
+    (index of the first item, list of items) and returns (index of the first item, list of the results), so that
+    results given in completion order (e.g. by Pool.imap_unordered) can be put back in place. """
+
+    def __init__(self,function):
+        self.function=function
+
+
+    def __call__(self,task):
+        return task[0],[self.function(item) for item in task[1]]
+
+
+class simulation_interrupted(Exception):
+    """ Raised by row_monitor when the simulation is cancelled or its deadline is passed. reason is 'cancelled'
+    or 'deadline'. """
+
+    def __init__(self,reason,rows_done,n_rows):
+        super().__init__("simulation "+("cancelled" if reason=='cancelled' else "deadline passed")+" after "+str(rows_done)+"/"+str(n_rows)+" rows")
+        self.reason=reason
+        self.rows_done=rows_done
+        self.n_rows=n_rows
+
+
+class row_monitor:
+    """ Follows the simulation of n_rows rows, as the backends report the rows done. progress, if set, is called
+    with a progress record (rows done, elapsed time, rows per second and estimated time to completion) at most
+    every progress_interval seconds and when all the rows are done. The simulation is interrupted (check raises
+    simulation_interrupted) as soon as cancel (an object with an is_set method, e.g. a threading.Event) is set or
+    the deadline (a time.time() value) is passed; the backends waiting for their workers check it every
+    poll_interval seconds at most. """
+
+    def __init__(self,n_rows,progress=None,cancel=None,deadline=None,progress_interval=0.5,poll_interval=0.2):
+        self.n_rows=n_rows
+        self.progress=progress
+        self.cancel=cancel
+        self.deadline=deadline
+        self.progress_interval=progress_interval
+        self.poll_interval=poll_interval
+        self.rows_done=0
+        self.t0=time.perf_counter()
+        self.last_progress=None
+
+
+    def update(self,rows):
+        """ Adds rows to the rows done, reports the progress and checks whether the simulation must stop. """
+        self.rows_done+=rows
+        t=time.perf_counter()
+        if self.progress is not None and (self.rows_done>=self.n_rows or self.last_progress is None or t-self.last_progress>=self.progress_interval):
+            self.last_progress=t
+            elapsed=t-self.t0
+            rate=self.rows_done/elapsed if elapsed>0 else None
+            self.progress({'type':'progress','rows_done':self.rows_done,'rows':self.n_rows,'elapsed_seconds':elapsed,'rows_per_second':rate,
+                           'eta_seconds':(self.n_rows-self.rows_done)/rate if rate else None})
+        self.check()
+
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise simulation_interrupted('cancelled',self.rows_done,self.n_rows)
+        if self.deadline is not None and time.time()>=self.deadline:
+            raise simulation_interrupted('deadline',self.rows_done,self.n_rows)
+
+
+    def pollTimeout(self):
+        """ Time [s] the backends can wait for their workers before checking again. """
+        if self.deadline is None:
+            return self.poll_interval
+        return max(0.,min(self.poll_interval,self.deadline-time.time()))
+
+
+def task_rows(result):
+    """ Number of rows done by a block task, given its result (possibly paired with the worker statistics, see
+    profiling.timed_function). """
+    return result[0] if isinstance(result,tuple) else result
+
+
+class task_feeder:
+    """ Iterable of the tasks given to Pool.imap_unordered, yielding a new task only when one of the max_pending tasks
+    already given has been collected (see wait_results). Pool.terminate hangs if the task handler thread of the pool is
+    blocked sending a task that no worker will read, which happens with tasks larger than the pipe buffer (e.g. chunks
+    of rows): with at most one pending task per worker, every task sent is read by an idle worker, and stop, to be
+    called before terminating the pool, waits for the task handler to be done with the feeder. """
+
+    def __init__(self,tasks,max_pending):
+        self.tasks=tasks
+        self.slots=threading.Semaphore(max_pending)
+        self.stopped=False
+        self.finished=threading.Event()
+
+
+    def __iter__(self):
+        try:
+            for task in self.tasks:
+                self.slots.acquire()
+                if self.stopped:
+                    break
+                yield task
+        finally:
+            self.finished.set()
+
+
+    def collected(self):
+        self.slots.release()
+
+
+    def stop(self,timeout=10.):
+        self.stopped=True
+        self.slots.release()
+        self.finished.wait(timeout)
+
+
+def wait_results(results,n_results,monitor=None,rows=task_rows,feeder=None):
+    """ Collects n_results results from the iterator given by Pool.imap_unordered, in completion order. If monitor is
+    set (see row_monitor), it is updated with the rows(result) rows done by each result and checked while waiting.
+    feeder, if set, is the task_feeder of the tasks, told of each result collected. """
+    from multiprocessing import TimeoutError
+    collected=list()
+    while len(collected)<n_results:
+        if monitor is None:
+            result=results.next()
+        else:
+            try:
+                result=results.next(monitor.pollTimeout())
+            except TimeoutError:
+                monitor.check()
+                continue
+        collected.append(result)
+        if feeder is not None:
+            feeder.collected()
+        if monitor is not None:
+            monitor.update(rows(result))
+    return collected
+
+
+def shared_array(shape,dtype,source=None):
+    """ Returns a new array placed in a shared memory block, filled with zeros or, if source is given, with a copy of
+    source. The worker processes of shared_memory_pool access it, and its views, in place. The block is released when
+    the array and all its views are deleted. """
+    from multiprocessing import shared_memory
+    dtype=numpy.dtype(dtype)
+    #~ new shared memory blocks are filled with zeros
+    shm=shared_memory.SharedMemory(create=True,size=max(1,int(numpy.prod(shape))*dtype.itemsize))
+    array=numpy.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    if source is not None:
+        array[...]=source
+    _shared_arrays[id(array)]=(weakref.ref(array),shm.name)
+    weakref.finalize(array,_release_shared,shm,id(array))
+    return array
+
+
+def _release_shared(shm,key):
+    _shared_arrays.pop(key,None)
+    shm.close()
+    shm.unlink()
+
+
+def shared_location(array):
+    """ Returns (shared memory block name, shape, dtype, offset, strides) locating array in the shared memory block
+    of the array given by shared_array it belongs to (array itself or a view of it), None if array is not in
+    shared memory. """
+    for owner in (array,array.base):
+        entry=_shared_arrays.get(id(owner))
+        if entry is not None and entry[0]() is owner:
+            offset=array.__array_interface__['data'][0]-owner.__array_interface__['data'][0]
+            return (entry[1],array.shape,array.dtype,offset,array.strides)
+    return None
+
+
+def _attach(name,shape,dtype,offset,strides):
+    from multiprocessing import shared_memory
+    if name not in _attached:
+        _attached[name]=shared_memory.SharedMemory(name=name)
+    return numpy.ndarray(shape,dtype=dtype,buffer=_attached[name].buf,offset=offset,strides=strides)
+
+
+def _detach(names):
+    for name in list(_attached.keys()):
+        if name not in names:
+            _attached.pop(name).close()
+
+
+def _sim_shared_block(task):
+    block,job=task
+    input_location,output_location,rsp,sim_function=job
+    _detach((input_location[0],output_location[0]))
+    return sim_block(_attach(*input_location),_attach(*output_location),block,rsp,sim_function)
+
+
+class thread_pool:
+    """ Pool of threads simulating row blocks of the input working image directly into the output image, with
+    no copies at all: threads share the arrays of the calling process. Only useful when the row function spends
+    most of its time in numpy calls releasing the GIL (the vectorized engine on long rows); same interface of
+    shared_memory_pool. """
+
+    def __init__(self,n_workers):
+        from concurrent.futures import ThreadPoolExecutor
+        self.n_workers=n_workers
+        self.executor=ThreadPoolExecutor(n_workers,thread_name_prefix='dsarsim-rows')
+
+
+    def simulate(self,input_array,output_array,rsp,sim_function,block_rows=None,task_wrapper=None,monitor=None):
+        """ Simulates all the rows of input_array into output_array and returns the list of the task results
+        (see shared_memory_pool.simulate). If the monitor interrupts the simulation, the running blocks are
+        stopped at their next row. """
+        from concurrent.futures import wait,FIRST_COMPLETED
+        n_rows=input_array.shape[0]
+        if block_rows is None:
+            block_rows=default_block_rows(n_rows,self.n_workers)
+        task_function=sim_block if task_wrapper is None else task_wrapper(sim_block)
+        stop=threading.Event()
+        futures=[self.executor.submit(task_function,input_array,output_array,block,rsp,sim_function,stop) for block in row_blocks(n_rows,block_rows)]
+        try:
+            pending=futures
+            while len(pending)>0:
+                done,pending=wait(pending,None if monitor is None else monitor.pollTimeout(),FIRST_COMPLETED)
+                if monitor is not None:
+                    monitor.update(sum(task_rows(future.result()) for future in done))
+        except BaseException:
+            stop.set()
+            raise
+        return [future.result() for future in futures]
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor=None
+
+
+    def terminate(self):
+        #~ running threads cannot be stopped: only the blocks not started yet are dropped (before Python 3.9, which
+        #~ cannot cancel them, they are left at their first row, see simulate)
+        if self.executor is not None:
+            try:
+                self.executor.shutdown(wait=True,cancel_futures=True)
+            except TypeError:
+                self.executor.shutdown(wait=True)
+            self.executor=None
+
+
+def auto_backend(engine,n_rows,n_columns,n_workers):
+    """ Backend chosen by the 'auto' setting for an image of n_rows x n_columns pixels and n_workers workers
+    (limited to the available cores): 'serial' for one worker or small images, where starting workers costs
+    more than it saves; 'threads' for the vectorized engine, whose rows are mostly simulated by numpy calls
+    releasing the GIL, on rows long enough; 'shared_memory' processes otherwise, e.g. for the reference engine,
+    which holds the GIL. """
+    n_workers=min(n_workers,os.cpu_count() or 1)
+    n_pixels=n_rows*n_columns
+    if n_workers<=1 or n_rows<2*n_workers or n_pixels<auto_min_pixels:
+        return 'serial'
+    if engine=='vectorized' and n_columns>=auto_min_thread_columns:
+        return 'threads'
+    return 'shared_memory'
+
+
+#~ thresholds of auto_backend
+auto_min_pixels=2**18
+auto_min_thread_columns=2048
+
+
+class shared_memory_pool:
+    """ Pool of worker processes simulating row blocks of images placed in shared memory (see shared_array).
+    Contiguous row blocks are distributed to the workers, which attach to the shared memory blocks of the input
+    working image and of the output image and write their results directly into the shared output. Each task
+    only carries the block bounds, the location of the arrays in shared memory and the simulation parameters (a
+    few hundred bytes); rows and results are never pickled. Arrays not in shared memory are copied into it for
+    the simulation. """
+
+    def __init__(self,n_workers):
+        from multiprocessing import Pool, resource_tracker
+
+        #~ workers must share the resource tracker of this process, otherwise their own trackers
+        #~ would unlink the shared memory blocks they attached to when they exit
+        resource_tracker.ensure_running()
+
+        self.n_workers=n_workers
+        self.pool=Pool(n_workers)
+
+
+    def simulate(self,input_array,output_array,rsp,sim_function,block_rows=None,task_wrapper=None,monitor=None):
+        """ Simulates all the rows of input_array into output_array and returns the list of the task results
+        (the number of rows of each block), in completion order. If task_wrapper is given, the function run by
+        the workers is task_wrapper(task function), e.g. profiling.profiler.workerFunction. If monitor is given
+        (see row_monitor), it follows the blocks as they are done and can interrupt the simulation, raising
+        simulation_interrupted: the pool must then be terminated. """
+        n_rows=input_array.shape[0]
+        if block_rows is None:
+            block_rows=default_block_rows(n_rows,self.n_workers)
+
+        shared_input=input_array if shared_location(input_array) is not None else shared_array(input_array.shape,input_array.dtype,input_array)
+        shared_output=output_array if shared_location(output_array) is not None else shared_array(output_array.shape,output_array.dtype)
+
+        job=(shared_location(shared_input),shared_location(shared_output),rsp,sim_function)
+        task_function=_sim_shared_block if task_wrapper is None else task_wrapper(_sim_shared_block)
+        tasks=[(block,job) for block in row_blocks(n_rows,block_rows)]
+        results=wait_results(self.pool.imap_unordered(task_function,tasks,chunksize=1),len(tasks),monitor)
+        if shared_output is not output_array:
+            output_array[...]=shared_output
+        return results
+
+
+    def close(self):
+        """ Stops the worker processes once their tasks are done. """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool=None
+
+
+    def terminate(self):
+        """ Stops the worker processes at once. """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool=None
@@ -0,0 +1,176 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+import os,time,json,contextlib,cProfile,pstats
+
+
+def peak_rss():
+    """ Returns the peak resident set size [bytes] of this process and of its terminated children,
+    or (None,None) if not available on this platform. """
+    try:
+        import resource,sys
+    except ImportError:
+        return None,None
+    #~ ru_maxrss is given in kilobytes on Linux and in bytes on macOS
+    unit=1 if sys.platform=='darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*unit,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*unit
+
+
+class timed_function:
+    """ Picklable wrapper of a function run by the workers. Each call returns the result of the function together
+    with the worker statistics (process id, wall time [s], CPU time [s] of the calling thread and, if cprofile is
+    set, the cProfile statistics of the call, None if another profiler is already active in the process). """
+
+    def __init__(self,function,cprofile=False):
+        self.function=function
+        self.cprofile=cprofile
+
+
+    def __call__(self,*args):
+        t0,c0=time.perf_counter(),time.thread_time()
+        profile_stats=None
+        profile=None
+        if self.cprofile:
+            profile=cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                #~ Python 3.12+ allows only one active profiler per process
+                profile=None
+        try:
+            result=self.function(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+        if profile is not None:
+            profile.create_stats()
+            profile_stats=profile.stats
+        return result,(os.getpid(),time.perf_counter()-t0,time.thread_time()-c0,profile_stats)
+
+
+class _profile_stats:
+    """ Minimal object accepted by pstats.Stats, holding statistics collected in another process. """
+
+    def __init__(self,stats):
+        self.stats=stats
+
+    def create_stats(self):
+        pass
+
+
+class profiler:
+    """ Collects structured timing records of the simulation steps. Each stage gives one record (a dictionary)
+    with its wall and CPU time and the peak resident memory; the work done by the worker processes gives one
+    record with the number of rows and the time spent by each worker. Records are kept in self.records and
+    passed, as soon as they are available, to callback (if set) and to logger (a logging.Logger, if set).
+    If profile_workers is set, the worker calls are also run under cProfile and their statistics are merged. """
+
+    def __init__(self,callback=None,logger=None,profile_workers=False):
+        self.callback=callback
+        self.logger=logger
+        self.profile_workers=profile_workers
+        self.records=list()
+        self.worker_profile=None
+        self.depth=0
+
+
+    @contextlib.contextmanager
+    def stage(self,name,**fields):
+        """ Context manager timing one stage of the simulation. fields are added to the stage record. """
+        t0,c0=time.perf_counter(),time.process_time()
+        self.depth+=1
+        try:
+            yield
+        finally:
+            self.depth-=1
+            rss,children_rss=peak_rss()
+            record={'type':'stage','name':name,'depth':self.depth,'wall_seconds':time.perf_counter()-t0,
+                    'cpu_seconds':time.process_time()-c0,'peak_rss_bytes':rss,'peak_children_rss_bytes':children_rss}
+            record.update(fields)
+            self.emit(record)
+
+
+    def workerFunction(self,function,threads=False):
+        """ Returns function wrapped so that the workers return their statistics (see timed_function). If threads is set
+        (workers are threads of this process), the calls are not run under cProfile, since Python 3.12+ allows only one
+        active profiler per process. """
+        return timed_function(function,self.profile_workers and not threads)
+
+
+    def addWorkerResults(self,name,tasks,wall_seconds):
+        """ Emits the record of the work done by the workers in one stage. tasks is a list of
+        (rows,worker statistics) tuples, one per task; wall_seconds is the wall time of the whole stage. """
+        workers=dict()
+        for rows,(pid,wall,cpu,profile_stats) in tasks:
+            worker=workers.setdefault(pid,{'pid':pid,'tasks':0,'rows':0,'wall_seconds':0.,'cpu_seconds':0.})
+            worker['tasks']+=1
+            worker['rows']+=rows
+            worker['wall_seconds']+=wall
+            worker['cpu_seconds']+=cpu
+            if profile_stats is not None:
+                if self.worker_profile is None:
+                    self.worker_profile=pstats.Stats(_profile_stats(profile_stats))
+                else:
+                    self.worker_profile.add(_profile_stats(profile_stats))
+        for worker in workers.values():
+            worker['rows_per_second']=worker['rows']/worker['wall_seconds'] if worker['wall_seconds']>0 else None
+        rows=sum(worker['rows'] for worker in workers.values())
+        busy_seconds=sum(worker['wall_seconds'] for worker in workers.values())
+        self.emit({'type':'workers','name':name,'depth':self.depth,'rows':rows,'wall_seconds':wall_seconds,
+                   'rows_per_second':rows/wall_seconds if wall_seconds>0 else None,
+                   'worker_busy_seconds':busy_seconds,'workers':sorted(workers.values(),key=lambda w: w['pid'])})
+
+
+    def emit(self,record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+        if self.logger is not None:
+            self.logger.info("%s",json.dumps(record),extra={'dsarsim_record':record})
+
+
+    def summary(self,n_functions=30):
+        """ Returns the records, the total wall and CPU time of each stage and, if collected, the
+        n_functions worker functions with the highest cumulative time. """
+        stages=dict()
+        for record in self.records:
+            if record['type']=='stage':
+                total=stages.setdefault(record['name'],{'count':0,'wall_seconds':0.,'cpu_seconds':0.})
+                total['count']+=1
+                total['wall_seconds']+=record['wall_seconds']
+                total['cpu_seconds']+=record['cpu_seconds']
+        rss,children_rss=peak_rss()
+        result={'records':self.records,'stages':stages,'peak_rss_bytes':rss,'peak_children_rss_bytes':children_rss}
+        if self.worker_profile is not None:
+            functions=list()
+            for (filename,line,function),(cc,nc,tt,ct,callers) in self.worker_profile.stats.items():
+                functions.append({'function':function,'file':filename,'line':line,'calls':nc,'primitive_calls':cc,
+                                  'total_seconds':tt,'cumulative_seconds':ct})
+            functions.sort(key=lambda f: f['cumulative_seconds'],reverse=True)
+            result['worker_profile']=functions[:n_functions]
+        return result
+
+
+    def write(self,filename):
+        """ Writes the summary to filename as JSON. Returns 0 on success, -1 otherwise. """
+        try:
+            with open(filename,'w') as f:
+                json.dump(self.summary(),f,indent=2)
+        except:
+            return -1
+        return 0
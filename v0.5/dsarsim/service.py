@@ -0,0 +1,452 @@
+#   Copyright 2015 Adamo Ferro
+#
+#   This file is part of dSARsim.
+#
+#   dSARsim is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   dSARsim is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with dSARsim. If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Long running simulation service. Simulation jobs (input file, output file and simulation parameters) are
+submitted through a small local HTTP interface, served on a TCP port or on a Unix socket, and queued in a bounded
+queue. Jobs are run by a fixed number of runner threads, each owning a simulator whose worker pool is kept alive
+between jobs; input images are kept in memory (see common.cache.image_cache), and a runner simulating the same input
+image of its previous job also reuses its rotated working image and reference height. This removes the fixed costs
+of each dsarsim.py run (interpreter startup, imports, input reading and pool creation) from small jobs.
+
+HTTP interface (JSON bodies and responses):
+POST /jobs                  submits a job (see job_parameters); replies 202 with the job status, 400 if the
+                            parameters are not valid, 503 if the queue is full
+GET /jobs/ID[?wait=SECONDS] returns the job status, waiting up to SECONDS for the job to finish
+GET /jobs/ID/events         streams the job status (one JSON object per line) at each change, including the progress
+                            of the simulation, until the job finishes
+POST /jobs/ID/cancel        cancels the job: a queued job is dropped, a running job is stopped and its worker
+                            processes terminated; replies with the job status
+GET /status                 returns the state of the service
+POST /shutdown              stops the service once the running jobs are finished """
+
+
+import os,stat,json,time,queue,itertools,threading,collections,socketserver
+import http.server
+import urllib.parse
+
+from .simulator import simulator,output_types,oblique_modes
+from .common.cache import image_cache,rotation_cache,result_cache
+
+
+#~ job parameters: name -> (type, default value); names and meaning are those of the dsarsim.py options
+job_parameters={'input':(str,None),'output':(str,None),'incidenceAngle':(float,30.),'aspectAngle':(float,0.),
+                'direction':(str,'w'),'azimuthPixelSpacing':(float,0.),'slantRangePixelSpacing':(float,0.),
+                'noDataValue':(float,-9999.),'rotateBack':(bool,False),'oblique':(str,'rotate'),'layers':(bool,False),'outputType':(str,'float32'),
+                'compress':(str,None),'overviews':(bool,False),'preview':(bool,False),'previewLevel':(int,None),'timeout':(float,None)}
+
+job_states=('queued','running','done','error')
+
+
+def parse_job(request):
+    """ Returns the job parameters given by the request dictionary, with defaults for the missing ones.
+    Raises ValueError if a parameter is unknown or not valid. """
+    unknown=set(request.keys())-set(job_parameters.keys())
+    if len(unknown)>0:
+        raise ValueError("unknown parameters "+", ".join(sorted(unknown)))
+    parameters=dict()
+    for name,(parameter_type,default) in job_parameters.items():
+        value=request.get(name,default)
+        if value is not None:
+            if parameter_type is bool and not isinstance(value,bool):
+                raise ValueError("parameter "+name+" must be true or false")
+            if parameter_type is int and (isinstance(value,bool) or not isinstance(value,(int,float)) or value!=int(value)):
+                raise ValueError("parameter "+name+" must be an integer")
+            value=parameter_type(value)
+        parameters[name]=value
+    for name in ('input','output'):
+        if not parameters[name]:
+            raise ValueError("missing parameter "+name)
+    if parameters['direction'] not in ('w','e'):
+        raise ValueError("invalid direction '"+parameters['direction']+"'")
+    if parameters['oblique'] not in oblique_modes:
+        raise ValueError("invalid oblique mode '"+parameters['oblique']+"'")
+    if parameters['outputType'] not in output_types:
+        raise ValueError("invalid output type '"+parameters['outputType']+"'")
+    if parameters['compress'] not in (None,'DEFLATE','ZSTD','LZW'):
+        raise ValueError("invalid compression '"+parameters['compress']+"'")
+    return parameters
+
+
+class simulation_service:
+    """ Job queue and runner threads of the service. Each of the n_runners runners simulates one job at a time
+    with its own simulator (and worker pool of n_subprocesses processes, engine and backend being those of the
+    service); at most queue_size jobs wait in the queue. Input images are cached up to image_cache_bytes; if
+    cache_dir is set, rotated working images are also cached on disk (see common.cache.rotation_cache); if
+    result_cache_dir is set, output files are cached too, so that jobs already simulated are served from the
+    cache (see common.cache.result_cache). The status of the last max_finished_jobs finished jobs is kept. """
+
+    def __init__(self,n_runners=1,queue_size=64,n_subprocesses=1,engine='reference',backend='pool',height_estimator='full',
+                 image_cache_bytes=2*2**30,cache_dir=None,cache_bytes=4*2**30,max_finished_jobs=10000,debug_mode=False,
+                 result_cache_dir=None,result_cache_bytes=4*2**30,result_cache_link=False):
+        self.n_runners=n_runners
+        self.n_subprocesses=n_subprocesses
+        self.engine=engine
+        self.backend=backend
+        self.height_estimator=height_estimator
+        self.cache_dir=cache_dir
+        self.cache_bytes=cache_bytes
+        self.result_cache_dir=result_cache_dir
+        self.result_cache_bytes=result_cache_bytes
+        self.result_cache_link=result_cache_link
+        self.max_finished_jobs=max_finished_jobs
+        self.debug_mode=debug_mode
+
+        self.images=image_cache(image_cache_bytes)
+        self.queue=queue.Queue(queue_size)
+        self.jobs=collections.OrderedDict()
+        self.finished=collections.deque()
+        self.condition=threading.Condition()
+        self.job_ids=itertools.count(1)
+        self.runners=list()
+        self.stopping=False
+
+
+    def start(self):
+        for i_runner in range(0,self.n_runners):
+            runner=threading.Thread(target=self._run,name="dsarsim-runner-"+str(i_runner),daemon=True)
+            runner.start()
+            self.runners.append(runner)
+
+
+    def stop(self):
+        """ Stops the runners once the running jobs are finished. Jobs still queued are set in error. """
+        self.stopping=True
+        for runner in self.runners:
+            self.queue.put(None)
+        for runner in self.runners:
+            runner.join()
+        self.runners=list()
+        while not self.queue.empty():
+            job=self.queue.get_nowait()
+            if job is not None:
+                self._setState(job,'error',error="service stopped")
+
+
+    def submit(self,request):
+        """ Queues a job. Returns its status, or None if the queue is full. Raises ValueError if the
+        request is not valid (see parse_job). """
+        parameters=parse_job(request)
+        if self.stopping:
+            return None
+        with self.condition:
+            job={'id':str(next(self.job_ids)),'state':'queued','parameters':parameters,'output':None,'error':None,
+                 'submitted':time.time(),'started':None,'finished':None,'progress':None,'updates':0,'cancel':threading.Event()}
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return None
+            self.jobs[job['id']]=job
+            return self.status(job)
+
+
+    def getJob(self,job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+
+    def status(self,job):
+        """ Status of the job as a JSON serializable dictionary. """
+        status={'id':job['id'],'state':job['state'],'input':job['parameters']['input'],'output':job['output'],'error':job['error']}
+        if job['progress'] is not None:
+            status['progress']={key:value for key,value in job['progress'].items() if key!='type'}
+        if job['started'] is not None:
+            status['queued_seconds']=job['started']-job['submitted']
+        if job['finished'] is not None and job['started'] is not None:
+            status['run_seconds']=job['finished']-job['started']
+        return status
+
+
+    def wait(self,job,timeout=None,state=None):
+        """ Waits up to timeout seconds for the job to leave state (or, if state is None, to finish)
+        and returns its status. """
+        with self.condition:
+            if state is None:
+                self.condition.wait_for(lambda: job['state'] in ('done','error'),timeout)
+            else:
+                self.condition.wait_for(lambda: job['state']!=state,timeout)
+            return self.status(job)
+
+
+    def nextUpdate(self,job,update=None):
+        """ Waits for a change of the job status after the given update number (none if update is None) and returns
+        the status and its update number. """
+        with self.condition:
+            self.condition.wait_for(lambda: job['updates']!=update)
+            return self.status(job),job['updates']
+
+
+    def cancel(self,job):
+        """ Cancels the job: a queued job is set in error at once, a running job as soon as its simulation stops
+        (see simulator.cancel_event). Returns the job status. """
+        with self.condition:
+            job['cancel'].set()
+            if job['state']=='queued':
+                self._setState(job,'error',error="cancelled")
+            return self.status(job)
+
+
+    def _setProgress(self,job,record):
+        with self.condition:
+            job['progress']=record
+            job['updates']+=1
+            self.condition.notify_all()
+
+
+    def info(self):
+        with self.condition:
+            states=collections.Counter(job['state'] for job in self.jobs.values())
+        return {'runners':self.n_runners,'subprocesses':self.n_subprocesses,'engine':self.engine,'backend':self.backend,
+                'queue_size':self.queue.maxsize,'jobs':{state:states.get(state,0) for state in job_states},
+                'image_cache':self.images.info()}
+
+
+    def _setState(self,job,state,**fields):
+        with self.condition:
+            job['state']=state
+            job.update(fields)
+            job['updates']+=1
+            if state in ('done','error'):
+                job['finished']=time.time()
+                self.finished.append(job['id'])
+                while len(self.finished)>self.max_finished_jobs:
+                    self.jobs.pop(self.finished.popleft(),None)
+            self.condition.notify_all()
+
+
+    def _run(self):
+        """ Runner thread: simulates the queued jobs until a None job is found. """
+        sarsim=simulator(sp=self.n_subprocesses,debug_mode=self.debug_mode,engine=self.engine,backend=self.backend)
+        sarsim.persistent_pool=True
+        sarsim.height_estimator=self.height_estimator
+        if self.cache_dir is not None:
+            sarsim.rotation_cache=rotation_cache(self.cache_dir,self.cache_bytes)
+        if self.result_cache_dir is not None:
+            sarsim.result_cache=result_cache(self.result_cache_dir,self.result_cache_bytes,self.result_cache_link)
+        try:
+            while True:
+                job=self.queue.get()
+                if job is None:
+                    break
+                with self.condition:
+                    if job['state']!='queued':
+                        #~ cancelled while queued
+                        continue
+                    if self.stopping:
+                        self._setState(job,'error',error="service stopped")
+                        continue
+                    self._setState(job,'running',started=time.time())
+                timeout=job['parameters']['timeout']
+                sarsim.cancel_event=job['cancel']
+                sarsim.deadline=None if timeout is None else job['started']+timeout
+                sarsim.progress_callback=lambda record,job=job: self._setProgress(job,record)
+                sarsim.interruption=None
+                try:
+                    error=self._simulate(sarsim,job['parameters'])
+                except Exception as e:
+                    error="unexpected error: "+repr(e)
+                finally:
+                    sarsim.resetOutputImage()
+                    sarsim.preview_image=None
+                    sarsim.cancel_event=sarsim.deadline=sarsim.progress_callback=None
+                if error is not None and sarsim.interruption is not None:
+                    error="cancelled" if sarsim.interruption=='cancelled' else "timeout reached"
+                if error is None:
+                    self._setState(job,'done',output=os.path.abspath(job['parameters']['output']))
+                else:
+                    self._setState(job,'error',error=error)
+        finally:
+            sarsim.close()
+
+
+    def _simulate(self,sarsim,parameters):
+        """ Simulates one job with the simulator of the runner. Returns None on success, the error message otherwise. """
+        img=self.images.get(parameters['input'],parameters['noDataValue'])
+        if img is None:
+            return "input image reading problem"
+        if img is not sarsim.input_image:
+            sarsim.setInputImage(img)
+        sarsim.setAngles(parameters['incidenceAngle'],parameters['aspectAngle'],parameters['direction'])
+        sarsim.user_opsize=(parameters['azimuthPixelSpacing'],parameters['slantRangePixelSpacing'])
+        sarsim.rotate_back=parameters['rotateBack']
+        sarsim.oblique=parameters['oblique']
+        sarsim.layers=parameters['layers']
+        sarsim.output_type=parameters['outputType']
+        sarsim.compression=parameters['compress']
+        sarsim.overviews=parameters['overviews']
+        sarsim.resetOutputImage()
+
+        if parameters['preview']:
+            if sarsim.simulatePreview(parameters['previewLevel'])!=0:
+                return "problem during preview simulation"
+            if sarsim.writePreviewImage(parameters['output'])!=0:
+                return "problem during output writing"
+        else:
+            key=None if sarsim.result_cache is None else sarsim.resultKey()
+            if sarsim.fetchCachedResult(parameters['output'],key)==0:
+                return None
+            if sarsim.simulate()!=0:
+                return "problem during simulation"
+            if sarsim.writeOutputImage(parameters['output'])!=0:
+                return "problem during output writing"
+            sarsim.storeResult(parameters['output'],key)
+        return None
+
+
+
+class request_handler(http.server.BaseHTTPRequestHandler):
+    """ HTTP interface of the service (see the module documentation). The service is server.service. """
+
+    def address_string(self):
+        #~ Unix socket clients have no address
+        return str(self.client_address[0]) if isinstance(self.client_address,tuple) and len(self.client_address)>0 else 'local'
+
+
+    def log_message(self,format,*args):
+        if self.server.service.debug_mode:
+            super().log_message(format,*args)
+
+
+    def do_POST(self):
+        service=self.server.service
+        path=urllib.parse.urlparse(self.path).path.rstrip('/')
+        parts=path.strip('/').split('/')
+        if path=='/jobs':
+            try:
+                request=json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))) or b'{}')
+                if not isinstance(request,dict):
+                    raise ValueError("the request must be a JSON object")
+                status=service.submit(request)
+            except ValueError as e:
+                self._reply(400,{'error':str(e)})
+                return
+            if status is None:
+                self._reply(503,{'error':'job queue full'})
+            else:
+                self._reply(202,status)
+        elif len(parts)==3 and parts[0]=='jobs' and parts[2]=='cancel':
+            job=service.getJob(parts[1])
+            if job is None:
+                self._reply(404,{'error':'unknown job'})
+            else:
+                self._reply(200,service.cancel(job))
+        elif path=='/shutdown':
+            threading.Thread(target=self.server.shutdown,daemon=True).start()
+            self._reply(200,{'state':'stopping'})
+        else:
+            self._reply(404,{'error':'not found'})
+
+
+    def do_GET(self):
+        service=self.server.service
+        url=urllib.parse.urlparse(self.path)
+        parts=url.path.strip('/').split('/')
+        if parts==['status']:
+            self._reply(200,service.info())
+        elif len(parts) in (2,3) and parts[0]=='jobs':
+            job=service.getJob(parts[1])
+            if job is None:
+                self._reply(404,{'error':'unknown job'})
+            elif len(parts)==3 and parts[2]=='events':
+                self._streamEvents(job)
+            elif len(parts)==2:
+                query=urllib.parse.parse_qs(url.query)
+                try:
+                    timeout=float(query['wait'][0]) if 'wait' in query else 0
+                except ValueError:
+                    self._reply(400,{'error':'invalid wait time'})
+                    return
+                self._reply(200,service.wait(job,timeout) if timeout>0 else service.status(job))
+            else:
+                self._reply(404,{'error':'not found'})
+        else:
+            self._reply(404,{'error':'not found'})
+
+
+    def _streamEvents(self,job):
+        service=self.server.service
+        self.send_response(200)
+        self.send_header('Content-Type','application/x-ndjson')
+        self.end_headers()
+        status,update=service.nextUpdate(job)
+        while True:
+            self.wfile.write((json.dumps(status)+"\n").encode())
+            self.wfile.flush()
+            if status['state'] in ('done','error'):
+                break
+            status,update=service.nextUpdate(job,update)
+
+
+    def _reply(self,code,content):
+        body=json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _tcp_server(http.server.ThreadingHTTPServer):
+    daemon_threads=True
+
+
+class _unix_server(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads=True
+
+
+def _is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def serve(address,service):
+    """ Serves the HTTP interface of service on address, until a shutdown request: address is either a Unix
+    socket path (if it contains a '/') or [HOST:]PORT, the default host being 127.0.0.1. Returns 0 when the
+    service stops, -1 if address is not valid or cannot be used. """
+
+    try:
+        if '/' in address:
+            if os.path.exists(address):
+                #~ only a stale socket is replaced, never another file
+                if not _is_socket(address):
+                    print("ERROR: Cannot serve on "+address+": the file exists and is not a socket.")
+                    return -1
+                os.remove(address)
+            server=_unix_server(address,request_handler)
+        else:
+            host,port=address.rsplit(':',1) if ':' in address else ('127.0.0.1',address)
+            server=_tcp_server((host,int(port)),request_handler)
+    except (OSError,ValueError) as e:
+        print("ERROR: Cannot serve on "+address+": "+str(e))
+        return -1
+    server.service=service
+
+    service.start()
+    if service.debug_mode:
+        print("INFO: Serving on "+address+" with "+str(service.n_runners)+" runners...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if '/' in address and _is_socket(address):
+            os.remove(address)
+    return 0
@@ -17,9 +17,11 @@
 
 
 import math, numpy
-import sys,copy
+import sys, time, copy, contextlib, hashlib
 
-from .common.image import image
+from .common.image import image, rotation_geometry, zoom_geometry, compact_type
+from .common.pyramid import pyramid
+from . import parallel
 
 
 class simulator:
@@ -27,17 +29,51 @@ class simulator:
     a method of the class. This choice is only due to some limitations of the multiprocessing library, which
     seems not to be able to use the function map with methods belonging to the same class of the calling function. """
         
-    def __init__(self,ia=30,aa=0,d='w',img=None,st=0.25,lt=0.25,opsize=(0,0),sp=1,debug_mode=False,rb=False):
+    def __init__(self,ia=30,aa=0,d='w',img=None,st=0.25,lt=0.25,opsize=(0,0),sp=1,debug_mode=False,rb=False,engine='reference',backend='pool'):
 
         self.debug_mode=debug_mode
 
         self.n_hist_bins=100            #~ TODO: set by user or calculated automatically?
+        self.height_estimator='full'    #~ reference height estimator, see _heightHistogram
+        self.height_sample_rate=0.01    #~ fraction of the pixels used by the 'sample' estimator...
+        self.height_min_samples=10**6   #~ ...but at least this number of pixels (all of them in smaller images)
         self.n_subprocesses=sp
+        self.engine=engine
+        self.backend=backend
+        self.block_rows=None            #~ rows per task of the shared memory backend, None = automatic
+        self.persistent_pool=False      #~ if True, the worker pool is kept alive between simulations until close() is called
+        self.pool=None
         self.rotate_back=rb
+        self.oblique='rotate'           #~ how the input image is brought to the viewing geometry, see oblique_modes
+        self.trace_strip_rows=1024      #~ working rows traced and simulated at once with the 'trace' oblique mode
 
         self.input_image=None
         self.input_working_image=None
+        self.working_rotation=None      #~ rotation [degrees] applied to the current input working image...
+        self.working_oblique=None       #~ ...and oblique mode used for it
+        self.reference_height=None      #~ reference height of the current input working image (see calculateOutputImageOffset)
+        self.input_histogram=None       #~ height histogram of the not rotated input image, reused for all the rotations
+        self.rotation_cache=None        #~ optional common.cache.rotation_cache of rotated working images
+        self.input_hash=None
+        self.result_cache=None          #~ optional common.cache.result_cache of output files, see resultKey
+        self.profiler=None              #~ optional profiling.profiler collecting the timings of the simulation stages
+        self.progress_callback=None     #~ optional function called with the progress records of the row simulations (see parallel.row_monitor)
+        self.cancel_event=None          #~ optional threading.Event (or any object with an is_set method) interrupting the simulations when set...
+        self.deadline=None              #~ ...and optional time.time() value interrupting them when passed
+        self.interruption=None          #~ reason of the interruption of the last simulation, if any: 'cancelled' or 'deadline'
         self.output_image=None
+        self.layers=False               #~ if True, the shadow mask, layover mask and LUT are also computed (see output_layers)
+        self.output_layers=None         #~ images of the output layers following the scatterer count, if computed
+        self.incremental=False          #~ if True, the output working image is kept for simulateUpdate
+        self.output_working_array=None
+        self.angle_outputs=None         #~ (output image, output layers) of each angle of the last simulateIncidenceAngles
+        self.angles_per_pass=8          #~ maximum number of incidence angles simulated together by simulateBatch
+        self.output_type='float32'      #~ data type of the output files, see output_types
+        self.compression=None           #~ compression of the output files, e.g. 'DEFLATE' or 'ZSTD' (see image.compression)
+        self.overviews=False            #~ if True, overviews are added to the output files
+        self.preview_pyramid=None       #~ reduced resolution levels of the input image (see simulatePreview)
+        self.preview_simulators=dict()  #~ simulators of the preview levels, by level
+        self.preview_image=None
         self.isize=None
         self.ipsize=None
         self.user_opsize=opsize
@@ -64,34 +100,198 @@ class simulator:
             self.aa_rad=aa*math.pi/180.
             self.row_sim_parameters.setIA(ia)
             self.resetOutputImage()
+            if self.input_image is not None:
+                self._updateAngularParameters()
 
 
     def setInputImage(self,img):
         """ Sets the input DTM/DSM image and calculates some parameters based on the image characteristics.
-        A working copy of the input image is created and will be used later on for the simulation. """
+        A working copy of the input image is created and will be used later on for the simulation: it shares
+        the data of the input image until a rotation is actually needed. """
         
         self.resetOutputImage()
         self.input_image=img
-        self.input_working_image=copy.deepcopy(img)
+        self.input_working_image=img.workingCopy()
+        self.working_rotation=0
+        self.reference_height=None
+        self.input_histogram=None
+        self.input_hash=None
+        self.preview_pyramid=None
+        self.preview_simulators=dict()
+        self.preview_image=None
         
         rsp=self.row_sim_parameters
         
         self.isize, self.ipsize=self.input_image.getImageInfo()
         rsp.iwpsize=self.ipsize
-        rsp.owpsize=(rsp.iwpsize[0],rsp.iwpsize[1]*rsp.sin_ia)
         
         self._updateWorkingImageSizes(self.isize)
+        self._updateAngularParameters()
+
+        rsp.nodatav=img.nodatav
+
+
+    def _updateAngularParameters(self):
+        """ Updates the simulation parameters depending on both incidence angle and input pixel spacing. """
+
+        rsp=self.row_sim_parameters
+
+        rsp.owpsize=(rsp.iwpsize[0],rsp.iwpsize[1]*rsp.sin_ia)
 
         rsp.s_angular_factor=rsp.iwpsize[1]/rsp.tan_ia
         l_angular_factor=rsp.iwpsize[1]*rsp.tan_ia
-        rsp.d_h_lo_min=l_angular_factor*(1-self.layover_tol)            
-        rsp.nodatav=img.nodatav
+        rsp.d_h_lo_min=l_angular_factor*(1-self.layover_tol)
 
         
     def resetOutputImage(self):
         self.output_image=None
+        self.output_layers=None
+        self.output_working_array=None
     
 
+    def _prepareWorkingImage(self):
+        """ Rotates the input working image as needed to simulate the current aspect angle and direction.
+        The rotated working image is kept, so that simulations sharing aspect angle and direction
+        (e.g. different incidence angles) do not rotate the input image again. With the 'trace' oblique
+        mode the input working image is not rotated: only the working sizes are set, and the working rows
+        are traced through it when simulated (see _simulateWorkingRows). """
+
+        rsp=self.row_sim_parameters
+
+        aa_tmp=0
+        if self.aa!=0 or self.direction!='w':
+            aa_tmp=(0 if self.direction=='w' else -180)+self.aa
+
+        if aa_tmp!=self.working_rotation or (aa_tmp!=0 and self.oblique!=self.working_oblique):
+            if self.working_rotation!=0:
+                self.input_working_image=self.input_image.workingCopy()
+                self._updateWorkingImageSizes(self.isize)
+            self.working_rotation=0
+            self.reference_height=None
+            self.resetOutputImage()
+            if aa_tmp!=0:
+                if self.oblique=='trace':
+                    self._updateWorkingImageSizes(rotation_geometry(self.isize,aa_tmp,True)[2])
+                    self.working_rotation=aa_tmp
+                    self.working_oblique=self.oblique
+                elif self._rotateWorkingImage(aa_tmp)==0:
+                    self._updateWorkingImageSizes(self.input_working_image.size)
+                    self.working_rotation=aa_tmp
+                    self.working_oblique=self.oblique
+                else:
+                    print("WARNING: Problem during DEM rotation. Using not rotated DEM, and thus aspect angle = 0 degrees.")
+
+
+    def _rotateWorkingImage(self,angle,order=3):
+        """ Rotates the input working image by angle degrees. If a rotation cache is set, the rotated image
+        is taken from the cache when available; otherwise it is computed from the cached spline coefficients
+        of the input image (computed and cached on first use) and stored into the cache. """
+
+        rsp=self.row_sim_parameters
+        cache=self.rotation_cache
+
+        if cache is None:
+            if self.debug_mode:
+                print("INFO: Rotating input DEM by "+str(angle)+" degrees to simulate aspect angle+direction...")
+            return self.input_working_image.rotate(angle,True,rsp.nodatav,order)
+
+        rotation_key=cache.rotationKey(self._inputHash(),angle,order,rsp.nodatav)
+        rotated=cache.get(rotation_key)
+        if rotated is not None:
+            if self.debug_mode:
+                print("INFO: Using cached input DEM rotated by "+str(angle)+" degrees.")
+            self.input_working_image.image=rotated
+            self.input_working_image.size=rotated.shape
+            return 0
+
+        coefficients_key=cache.coefficientsKey(self._inputHash(),order)
+        coefficients=cache.get(coefficients_key)
+        if coefficients is None:
+            if self.debug_mode:
+                print("INFO: Calculating spline coefficients of the input DEM...")
+            try:
+                coefficients=cache.put(coefficients_key,self.input_working_image.splineCoefficients(order))
+            except:
+                return -1
+
+        if self.debug_mode:
+            print("INFO: Rotating input DEM by "+str(angle)+" degrees to simulate aspect angle+direction...")
+        if self.input_working_image.rotate(angle,True,rsp.nodatav,order,coefficients)!=0:
+            return -1
+        self.input_working_image.image=cache.put(rotation_key,self.input_working_image.image)
+        return 0
+
+
+    def _inputHash(self):
+        """ Hash of the content of the input image, computed once per input image (by strips if its data is still
+        on disk). """
+        if self.input_hash is None:
+            self.input_hash=self.input_image.contentHash()
+        return self.input_hash
+
+
+    def loadInputImage(self):
+        """ Reads the data of an input image set with image.readInfo, e.g. once the result cache has been checked
+        without loading it (see fetchCachedResult), keeping the hash of its content. Returns 0 on success, -1 otherwise. """
+        input_hash=self.input_hash
+        if self.input_image.read(self.input_image.filename)!=0:
+            return -1
+        self.setInputImage(self.input_image)
+        self.input_hash=input_hash
+        return 0
+
+
+    def resultKey(self,mode='simulate'):
+        """ Key of the output file of the current simulation in the result cache: hash of the input image content and
+        of every parameter affecting the output file. Engine, backend and number of subprocesses give identical outputs
+        and are not part of it. mode is the simulation method writing the file ('simulate' or 'streaming'). Returns None
+        if the input image cannot be read. """
+        rsp=self.row_sim_parameters
+        input_hash=self._inputHash()
+        if input_hash is None:
+            return None
+        parameters=(result_key_version,mode,input_hash,tuple(self.ipsize),rsp.nodatav,rsp.ia,self.aa,self.direction,
+                    tuple(self.user_opsize),self.rotate_back,rsp.shadow_tol,self.layover_tol,self.n_hist_bins,
+                    self.height_estimator,self.height_sample_rate,self.height_min_samples,self.oblique,self.layers,
+                    self.output_type,self.compression,self.overviews)
+        return hashlib.blake2b(repr(parameters).encode(),digest_size=20).hexdigest()
+
+
+    def fetchCachedResult(self,filename,key=None,mode='simulate'):
+        """ Writes the output file of the current simulation to filename if found in the result cache (key is given by
+        resultKey(mode) if not set). Returns 0 on a cache hit, -1 if not cached or no result cache is set. """
+        if self.result_cache is None:
+            return -1
+        if key is None:
+            key=self.resultKey(mode)
+        if key is None or self.result_cache.get(key,filename)!=0:
+            return -1
+        if self.debug_mode:
+            print("INFO: Output "+filename+" taken from the result cache.")
+        return 0
+
+
+    def storeResult(self,filename,key=None,mode='simulate'):
+        """ Stores the output file filename of the current simulation into the result cache, if set (see fetchCachedResult).
+        Returns 0 on success, -1 otherwise. """
+        if self.result_cache is None:
+            return 0
+        if key is None:
+            key=self.resultKey(mode)
+        if key is None or self.result_cache.put(key,filename)!=0:
+            print("WARNING: Problem storing "+filename+" into the result cache.")
+            return -1
+        return 0
+
+
+    def _workingWindow(self,img,angle,tl_corner,size,margin=16):
+        """ Returns a window of the working image that img gives once rotated by angle, according to the oblique mode
+        (see image.readRotatedWindow and image.traceWindow). """
+        if self.oblique=='trace':
+            return img.traceWindow(angle,self.row_sim_parameters.nodatav,tl_corner,size)
+        return img.readRotatedWindow(angle,self.row_sim_parameters.nodatav,tl_corner,size,3,margin)
+
+
     def _updateWorkingImageSizes(self,ws):
         rsp=self.row_sim_parameters
         rsp.iwsize=ws
@@ -112,114 +312,917 @@ class simulator:
             
             
             #~ retrieves the most frequent height value into the DTM/DSM and uses it as reference. The nodata value is not taken into account
-            hist,bin_edges=numpy.histogram(self.input_working_image.image[self.input_working_image.image!=rsp.nodatav],self.n_hist_bins)
-            bin_max=numpy.argmax(hist)
-            h_ref=(bin_edges[bin_max]+bin_edges[bin_max+1])/2.
-            d=h_ref*rsp.cos_ia
-            x_offset=-int(round(d/rsp.owpsize[1]))
-            rsp.output_working_image_offset=x_offset
-            
-            if self.debug_mode:
-                print("INFO: Reference height [m]                      = "+str(h_ref))
-                print("INFO: Output image offset [pixels]              = "+str(rsp.output_working_image_offset))
-                print("INFO: Working output slant range pixel size [m] = "+str(rsp.owpsize[1]))
+            if self.reference_height is None:
+                hist,bin_edges=self._heightHistogram()
+                self._setReferenceHeight(hist,bin_edges)
+            self._setOutputImageOffset()
+
+
+    def _heightHistogram(self,strip_rows=1024):
+        """ Returns the height histogram used to set the reference height, and its bin edges, according to height_estimator:
+        'full' = all the pixels of the input working image, i.e. after rotation (exact, default; with the 'trace' oblique
+        mode the working image is never materialized, and the not rotated input is used);
+        'input' = all the pixels of the not rotated input image;
+        'sample' = one pixel every k rows and k columns of the not rotated input image, k being chosen to use about
+        height_sample_rate of the pixels but at least height_min_samples of them;
+        'gdal' = histogram computed by GDAL on the input file, using its overviews if any ('sample' if not available).
+        The rotation only resamples the heights and pads them with nodata, so the histogram of the not rotated input
+        gives the same reference height but for a fraction of bin; it is computed once and reused for all the rotations.
+        With the 'sample' estimator the relative standard error of the count of a bin holding a fraction p of the
+        pixels is about 1/sqrt(p*n_samples). """
+
+        rsp=self.row_sim_parameters
+
+        if self.height_estimator=='full' and self.input_working_image.image is not None:
+            return self.input_working_image.histogram(self.n_hist_bins,rsp.nodatav,1,strip_rows)
+
+        if self.input_histogram is None:
+            if self.height_estimator=='gdal':
+                self.input_histogram=self.input_image.gdalHistogram(self.n_hist_bins,rsp.nodatav)
+                if self.input_histogram is None and self.debug_mode:
+                    print("INFO: GDAL height statistics not available, using a sample of the input DEM.")
+            if self.input_histogram is None:
+                step=1
+                if self.height_estimator in ('sample','gdal'):
+                    n_pixels=self.isize[0]*self.isize[1]
+                    step=max(1,int(round(1./math.sqrt(self.height_sample_rate))))
+                    step=max(1,min(step,int(math.sqrt(n_pixels/self.height_min_samples))))
+                if self.debug_mode:
+                    print("INFO: Calculating height histogram of the input DEM (1 pixel every "+str(step)+" rows and columns)...")
+                self.input_histogram=self.input_image.histogram(self.n_hist_bins,rsp.nodatav,step,strip_rows)
+        return self.input_histogram
+
+
+    def _setReferenceHeight(self,hist,bin_edges):
+        """ Sets as reference height the center of the most populated histogram bin. """
+        bin_max=numpy.argmax(hist)
+        self.reference_height=(bin_edges[bin_max]+bin_edges[bin_max+1])/2.
+
+
+    def _setOutputImageOffset(self):
+        """ Sets the output image offset corresponding to the reference height. """
+
+        rsp=self.row_sim_parameters
+
+        h_ref=self.reference_height
+        d=h_ref*rsp.cos_ia
+        x_offset=-int(round(d/rsp.owpsize[1]))
+        rsp.output_working_image_offset=x_offset
+        
+        if self.debug_mode:
+            print("INFO: Reference height [m]                      = "+str(h_ref))
+            print("INFO: Output image offset [pixels]              = "+str(rsp.output_working_image_offset))
+            print("INFO: Working output slant range pixel size [m] = "+str(rsp.owpsize[1]))
 
  
     def simulate(self):
         """ Applies a rotation to the input working image, if necessary; allocates the output image and prepares
         the input data to be processed by the actual pseudo-simulation external function, which is called through
-        multiprocessing.map. The results are then recomposed to form the output image. If the user manually set
-        azimuth and/or range spacing, the output image is scaled accordingly.
+        the selected parallel backend (see _simulateRows). The results are then recomposed to form the output image.
+        If the user manually set azimuth and/or range spacing, the output image is scaled accordingly.
         Rotations are used to simulate different aspect angles and/or viewing directions. This avoids to take 
         these effects into account in the actual simulation code, which is kept as simple as possible. """
         
         if self.input_working_image is not None:
         
             rsp=self.row_sim_parameters
+
+            sim_function=self._rowFunction()
+            if sim_function is None:
+                return -1
+
+            with self._stage('simulate',ia=rsp.ia,aa=self.aa,d=self.direction,engine=self.engine,backend=self.backend,n_subprocesses=self.n_subprocesses):
             
-            if self.aa!=0 or self.direction!='w':
-                aa_tmp=(0 if self.direction=='w' else -180)+self.aa
+                with self._stage('rotation'):
+                    self._prepareWorkingImage()
+                    self._shareWorkingImage()
+
+                with self._stage('histogram'):
+                    self.calculateOutputImageOffset()
+
                 if self.debug_mode:
-                    print("INFO: Rotating input DEM by "+str(aa_tmp)+" degrees to simulate aspect angle+direction...")
-                if self.input_working_image.rotate(aa_tmp,True,rsp.nodatav)==0:
-                    self._updateWorkingImageSizes(self.input_working_image.size)
+                    print("INFO: Creating output working image...")         
+                with self._stage('allocation'):
+                    if self.layers:
+                        #~ working layers are stored as one array, so that the row functions write all of them at once
+                        output_array=self._outputWorkingArray((len(working_layers),)+tuple(rsp.owsize),numpy.float32)
+                    else:
+                        output_array=self._outputWorkingArray(rsp.owsize,rsp.count_type)
+                
+                
+                if self._simulateWorkingRows(sim_function,output_array)!=0:
+                    return -1
+
+                self._setOutputWorkingImage(output_array)
+
+
+                with self._stage('postprocess'):
+                    self._postProcessOutputImage()
+                    
+            return 0
+        else:
+            print("ERROR: No input image has been selected.")
+            return -1
+
+    
+    def _rowFunction(self):
+        """ Checks the simulation settings and prepares the simulation parameters accordingly. Returns the row function of
+        the selected engine, or None if a setting is not valid. """
+        rsp=self.row_sim_parameters
+        if self.engine not in row_engines:
+            print("ERROR: Unknown row simulation engine '"+str(self.engine)+"'.")
+            return None
+        if self.oblique not in oblique_modes:
+            print("ERROR: Unknown oblique mode '"+str(self.oblique)+"'.")
+            return None
+        if self.height_estimator not in height_estimators:
+            print("ERROR: Unknown reference height estimator '"+str(self.height_estimator)+"'.")
+            return None
+        if not 0<self.height_sample_rate<=1:
+            print("ERROR: The height sample rate must be greater than 0 and not greater than 1.")
+            return None
+        if self.output_type not in output_types:
+            print("ERROR: Unknown output type '"+str(self.output_type)+"'.")
+            return None
+        if self.layers and (self.user_opsize[0]!=0 or self.user_opsize[1]!=0):
+            print("ERROR: Output layers are not supported with user defined pixel spacing.")
+            return None
+        rsp.layers=self.layers
+        rsp.count_type=self._countType()
+        return row_engines[self.engine]
+
+
+    def simulateIncidenceAngles(self,incidence_angles):
+        """ Simulates several incidence angles, with the current aspect angle and direction, in one single pass over the rows
+        of the input working image: each task simulates its rows for all the angles (see multi_angle_engine), so that every
+        row is read once and stays in cache, and the parallel dispatch is shared by all the angles. The input working image
+        and the reference height do not depend on the incidence angle and are computed once. The output images are
+        post-processed as in simulate and kept in angle_outputs as (output image, output layers) pairs, one per angle;
+        getOutputStack returns them as one (n_angles, rows, columns) array. When done, the incidence angle is the last one
+        and the output image is the one of the last angle. Returns 0 on success, -1 otherwise. """
+
+        if self.input_working_image is None:
+            print("ERROR: No input image has been selected.")
+            return -1
+        if len(incidence_angles)==0:
+            self.angle_outputs=list()
+            return 0
+
+        sim_function=self._rowFunction()
+        if sim_function is None:
+            return -1
+
+        with self._stage('simulate_angles',ia=list(incidence_angles),aa=self.aa,d=self.direction,engine=self.engine,backend=self.backend,n_subprocesses=self.n_subprocesses):
+
+            with self._stage('rotation'):
+                self._prepareWorkingImage()
+                self._shareWorkingImage()
+
+            #~ parameters of each angle: only the angular ones and the output image offset change
+            rsp_list=list()
+            with self._stage('histogram'):
+                for ia in incidence_angles:
+                    self.setAngles(ia,self.aa,self.direction)
+                    self.resetOutputImage()
+                    self.calculateOutputImageOffset()
+                    rsp_list.append(copy.copy(self.row_sim_parameters))
+            rsp=self.row_sim_parameters
+
+            if self.debug_mode:
+                print("INFO: Creating output working images of "+str(len(incidence_angles))+" incidence angles...")
+            with self._stage('allocation'):
+                output_array=self._outputWorkingArray((len(incidence_angles),)+((len(working_layers),) if self.layers else ())+tuple(rsp.owsize),rsp.count_type)
+
+            if self._simulateWorkingRows(multi_angle_engine(sim_function),output_array,rsp_list)!=0:
+                return -1
+
+            with self._stage('postprocess'):
+                self.angle_outputs=list()
+                for i_angle,ia in enumerate(incidence_angles):
+                    self.setAngles(ia,self.aa,self.direction)
+                    self.row_sim_parameters.output_working_image_offset=rsp_list[i_angle].output_working_image_offset
+                    self._setOutputWorkingImage(output_array[i_angle])
+                    self._postProcessOutputImage()
+                    self.angle_outputs.append((self.output_image,self.output_layers))
+
+        return 0
+
+
+    def getOutputStack(self):
+        """ Returns the output images of the last simulateIncidenceAngles as one (n_angles, rows, columns) array,
+        or None if they do not have the same size (e.g. with user defined pixel spacing). """
+        if not self.angle_outputs or len(set(tuple(img.image.shape) for img,layers in self.angle_outputs))!=1:
+            return None
+        return numpy.stack([img.image for img,layers in self.angle_outputs])
+
+
+    def _setOutputWorkingImage(self,output_array):
+        """ Sets the output image (and the output layers, if any) as the output working image held by output_array.
+        If incremental is set, output_array is also kept for simulateUpdate. """
+        rsp=self.row_sim_parameters
+        self.output_image=image(rsp.owsize,rsp.owpsize)
+        self.output_image.matrix_type=output_array.dtype.type
+        self.output_image.image=output_array[0] if self.layers else output_array
+        self.output_layers=None
+        if self.layers:
+            self.output_layers=[image(rsp.owsize,rsp.owpsize) for i_layer in range(1,len(output_layers))]
+            for i_layer in range(1,len(working_layers)):
+                self.output_layers[i_layer-1].image=output_array[i_layer]
+        self.output_working_array=output_array if self.incremental else None
+
+
+    def simulateUpdate(self,img,bbox=None,margin=16):
+        """ Updates the last simulation for a new input image img, of the same size, which differs from the previous
+        input image only inside bbox (first row, first column, last row + 1, last column + 1, in input pixels). If bbox
+        is None, it is computed comparing the two images. Since each row of the output working image only depends on the
+        same row of the input working image, only the working rows covering bbox are rotated and simulated again, and
+        patched into the output working image kept by the last simulation (incremental must be set before it); the
+        output working image is then post-processed again. The rotated rows are computed as image.readRotatedWindow
+        does, with bbox enlarged by margin pixels, and thus differ from a full rotation by less than 1e-6 times the
+        height range (no difference if the input is not rotated or with the 'trace' oblique mode, see _workingWindow).
+        The reference height, and thus the output image offset, of the last simulation is kept, so that new and old rows
+        match. If there is no simulation to update, a full simulation is carried out. """
+
+        rsp=self.row_sim_parameters
+
+        if self.output_image is None or self.output_working_array is None or (self.output_working_array.ndim==3)!=bool(self.layers):
+            if self.debug_mode:
+                print("INFO: No previous simulation kept, simulating the whole image.")
+            self.setInputImage(img)
+            return self.simulate()
+        if tuple(img.size)!=tuple(self.isize) or tuple(img.pixel_size)!=tuple(self.ipsize):
+            print("ERROR: The updated input image must have the same size and pixel spacing of the previous one.")
+            return -1
+        sim_function=self._rowFunction()
+        if sim_function is None:
+            return -1
+
+        if bbox is None:
+            changed=img.image!=self.input_image.image
+            rows=numpy.nonzero(changed.any(axis=1))[0]
+            cols=numpy.nonzero(changed.any(axis=0))[0]
+            del changed
+            if rows.size==0:
+                self.input_image=img
+                return 0
+            bbox=(rows[0],cols[0],rows[-1]+1,cols[-1]+1)
+
+        self.input_image=img
+        self.input_hash=None
+        self.input_histogram=None
+        self.preview_pyramid=None
+        self.preview_simulators=dict()
+
+        with self._stage('update',bbox=[int(b) for b in bbox]):
+            if self.working_rotation==0:
+                rows=(max(0,bbox[0]),min(rsp.iwsize[0],bbox[2]))
+            else:
+                #~ working rows covering the input area changed (working = inverse rotation of input coordinates)
+                rot_matrix,offset,rsize=rotation_geometry(self.isize,self.working_rotation,True)
+                corners=numpy.array([[y,x] for y in (bbox[0]-margin,bbox[2]+margin) for x in (bbox[1]-margin,bbox[3]+margin)],dtype=numpy.float64)
+                working_corners=numpy.linalg.solve(rot_matrix,(corners-offset).T)
+                rows=(max(0,int(numpy.floor(working_corners[0].min()))),min(rsp.iwsize[0],int(numpy.ceil(working_corners[0].max()))+1))
+            if self.working_rotation==0 or self._traced():
+                #~ the working rows are the input rows, or are traced through them
+                self.input_working_image=img.workingCopy()
+            elif rows[1]>rows[0]:
+                working=self.input_working_image.image
+                if isinstance(working,numpy.memmap) or not working.flags.writeable:
+                    working=numpy.array(working)
+                working[rows[0]:rows[1]]=self._workingWindow(img,self.working_rotation,(rows[0],0),(rows[1]-rows[0],rsp.iwsize[1]),margin)
+                self.input_working_image.image=working
+
+            if self.debug_mode:
+                print("INFO: Simulating again working rows "+str(rows[0])+" to "+str(rows[1]-1)+"...")
+            if rows[1]>rows[0]:
+                #~ new rows are accumulated as the kept ones
+                rsp.count_type=self.output_working_array.dtype.type
+                if self._simulateWorkingRows(sim_function,self.output_working_array,None,rows)!=0:
+                    return -1
+
+            self._setOutputWorkingImage(self.output_working_array)
+            with self._stage('postprocess'):
+                self._postProcessOutputImage()
+
+        return 0
+
+
+    def _postProcessOutputImage(self):
+        """ Brings the output working image to the final geometry: resizing to the user defined pixel spacing,
+        rotation by 180 degrees to restore North position (direction 'e'), rotation back by -aspect angle and
+        cropping to the input image size. These steps are composed into one single affine transform, applied
+        with nearest neighbour interpolation only on the final cropped extent. The 180 degrees rotation and the
+        cropping are exact, so pixel values can differ from the step by step result only where a sampling position
+        falls on a pixel boundary. Resizing and rotation back are both interpolations instead: composing them would
+        round the sampling positions once instead of twice and change many pixels, so when both are requested the
+        resized image is computed first. The 180 degrees rotation alone is a flipped view of the output working
+        image, with no copy. Output layers, if any, undergo the same transform; the working LUT is first converted
+        into row and column of the final output image (see lut_coordinates). """
+
+        rsp=self.row_sim_parameters
+        img=self.output_image
+
+        matrix=numpy.identity(2)
+        offset=numpy.zeros((2,))
+        size=img.size
+        pixel_size=img.pixel_size
+        transformed=False
+        flip_only=False
+
+        if self.user_opsize[0]!=0 or self.user_opsize[1]!=0:
+            scale_factors=[rsp.owpsize[i_psize]/self.user_opsize[i_psize] if self.user_opsize[i_psize]!=0 else 1 for i_psize in range(0,2)]
+            if self.debug_mode:
+                print("INFO: Resizing output image in order to simulate user defined pixel spacing.")
+            zoom,size=zoom_geometry(size,scale_factors)
+            matrix=numpy.diag(zoom)
+            pixel_size=[pixel_size[i_psize]/scale_factors[i_psize] for i_psize in range(0,2)]
+            transformed=True
+            if self.rotate_back and self.aa!=0:
+                #~ two interpolations, as in the step by step result (output layers are not computed with resizing)
+                if img.transform(matrix,offset,size,0,0)!=0:
+                    print("ERROR: Problem during output image resampling. Using not resampled output.")
+                    size,pixel_size=img.size,img.pixel_size
                 else:
-                    print("WARNING: Problem during DEM rotation. Using not rotated DEM, and thus aspect angle = 0 degrees.")
-                        
+                    img.pixel_size=pixel_size
+                matrix=numpy.identity(2)
+                transformed=False
 
-            self.calculateOutputImageOffset()
+        if self.direction=='e':
+            if self.debug_mode:
+                print("INFO: Rotating by 180 degrees to restore North position...")
+            flip_only=not transformed and not (self.rotate_back and self.aa!=0)
+            offset=offset+matrix.dot(numpy.array(size)-1.)
+            matrix=-matrix
+            transformed=True
 
+        if self.rotate_back and self.aa!=0:
             if self.debug_mode:
-                print("INFO: Creating output working image...")         
-            self.output_image=image(rsp.owsize,rsp.owpsize,0)
-            
-            
+                print("INFO: Rotating back output image...")
+            rot_matrix,rot_offset,rsize=rotation_geometry(size,-self.aa,True)
+            tl_corner=(int(rsize[0]/2)-int(self.isize[0]/2),int(rsize[1]/2)-int(self.isize[1]/2))
             if self.debug_mode:
-                print("INFO: Preparing input data for multiprocessing...")              
-            map_list=list()
-            for iY in range(0,rsp.iwsize[0]):
-                map_list.append((self.input_working_image.image[iY],rsp))
+                print("INFO: Cropping output image...")
+            offset=offset+matrix.dot(rot_offset+rot_matrix.dot(tl_corner))
+            matrix=matrix.dot(rot_matrix)
+            size=self.isize
+            transformed=True
 
+        images=[(img,0)]
+        if self.output_layers is not None:
+            lut=self.output_layers[-2].image
+            self.output_layers[-2].image,self.output_layers[-1].image=lut_coordinates(lut,0,matrix,offset,size)
+            images+=[(layer,-1 if output_layers[i_layer+1].startswith('lut') else 0) for i_layer,layer in enumerate(self.output_layers)]
 
-            self.multiprocessing_enabled=True
+        for img,cval in images:
+            if flip_only:
+                img.flip()
+            elif transformed:
+                if img.transform(matrix,offset,size,0,cval)!=0:
+                    print("ERROR: Problem during output image resampling. Using not resampled output.")
+                else:
+                    img.pixel_size=pixel_size
+
+
+    def writeOutputImage(self,filename):
+        """ Writes the output image to filename, with the output layers, if computed, as further bands (see output_layers).
+        The file type is the one set by output_type; with 'auto', the smallest integer type holding the maximum scatterer
+        count (and the LUT values, if layers are written). """
+        bands=None if self.output_layers is None else [layer.image for layer in self.output_layers]
+        data=[self.output_image.image]+([] if bands is None else bands)
+        self._setOutputFormat(self.output_image,max([int(d.max()) if d.size>0 else 0 for d in data]))
+        if self.output_layers is None:
+            return self.output_image.write(filename)
+        return self.output_image.write(filename,bands,output_layers)
+
+
+    def _countType(self):
+        """ Type of the output working image: scatterer counts are accumulated as integers when the output is written with
+        an integer type, unless layers are computed (the LUT holds -1 values and is kept, with the other layers, as
+        float32). """
+        if self.output_type=='float32' or self.layers:
+            return numpy.float32
+        return numpy.uint32
+
+
+    def _setOutputFormat(self,img,max_value):
+        """ Sets file type, compression and overviews of the output image img, whose values do not exceed max_value.
+        If max_value is None (not known in advance), 'auto' gives 16 bit integers, or the integers holding the LUT
+        values. """
+        rsp=self.row_sim_parameters
+        min_value=-1 if self.layers else 0
+        if self.output_type=='auto':
+            dtype=compact_type(min_value,max_value if max_value is not None else max(2**16-1,max(rsp.owsize)))
+        else:
+            dtype=numpy.dtype(self.output_type)
+            if self.layers and dtype.kind=='u':
+                dtype=compact_type(min_value,numpy.iinfo(dtype).max)
+            if dtype.kind!='f' and max_value is not None and max_value>numpy.iinfo(dtype).max:
+                print("WARNING: Output values up to "+str(max_value)+" do not fit into "+str(dtype)+": values are clipped.")
+        img.setFileType(dtype)
+        img.compression=self.compression
+        img.overviews=self.overviews
+        img.overview_resampling='NEAREST' if self.layers else 'AVERAGE'
+
+
+    def simulateBatch(self,configurations,output_filenames):
+        """ Simulates several viewing geometries on the same input image, writing one output image per configuration.
+        configurations is a list of (ia,aa,d) tuples and output_filenames the corresponding list of output files.
+        Configurations sharing aspect angle and direction, i.e. the rotation of the input working image, are
+        grouped, so that the input image is rotated only once per group; the worker pool is kept alive for the
+        whole batch. If a result cache is set, configurations already simulated are taken from the cache and the
+        new outputs are stored into it. Returns 0 if all the simulations and writings succeeded, -1 otherwise. """
+
+        if len(configurations)!=len(output_filenames):
+            print("ERROR: The number of output files does not match the number of configurations.")
+            return -1
+
+        result_keys=dict()
+        cached=set()
+        if self.result_cache is not None:
+            for i_conf,configuration in enumerate(configurations):
+                self.setAngles(*configuration)
+                result_keys[i_conf]=self.resultKey()
+                if self.fetchCachedResult(output_filenames[i_conf],result_keys[i_conf])==0:
+                    cached.add(i_conf)
+
+        def rotation(configuration):
+            ia,aa,d=configuration
+            return (0 if d=='w' else -180)+aa
+
+        batch_order=sorted([i_conf for i_conf in range(0,len(configurations)) if i_conf not in cached],key=lambda i_conf: (rotation(configurations[i_conf]),i_conf))
+
+        #~ configurations sharing aspect angle and direction are simulated angles_per_pass incidence angles at a time
+        passes=list()
+        for i_conf in batch_order:
+            ia,aa,d=configurations[i_conf]
+            if len(passes)>0 and configurations[passes[-1][0]][1:]==(aa,d) and len(passes[-1])<max(1,self.angles_per_pass):
+                passes[-1].append(i_conf)
+            else:
+                passes.append([i_conf])
+
+        result=0
+        self.interruption=None
+        persistent_pool=self.persistent_pool
+        self.persistent_pool=True
+        try:
+            for i_pass,batch_pass in enumerate(passes):
+                ia,aa,d=configurations[batch_pass[0]]
+                incidence_angles=[configurations[i_conf][0] for i_conf in batch_pass]
+                if self.debug_mode:
+                    print("INFO: Batch simulation of configurations "+", ".join([str(i_conf+1) for i_conf in batch_pass])+"/"+str(len(configurations))+": ia="+str(incidence_angles)+", aa="+str(aa)+", d="+d)
+                self.setAngles(ia,aa,d)
+                if self.simulateIncidenceAngles(incidence_angles)!=0:
+                    result=-1
+                    if self.interruption is not None:
+                        #~ cancelled or deadline passed: the following passes would be interrupted too
+                        print("ERROR: Batch interrupted, configurations not simulated: "+str([configurations[i_conf] for later_pass in passes[i_pass:] for i_conf in later_pass])+".")
+                        break
+                    print("ERROR: Problem during simulation of configurations "+str([configurations[i_conf] for i_conf in batch_pass])+".")
+                    continue
+                for i_conf,(output_image,layers) in zip(batch_pass,self.angle_outputs):
+                    self.output_image,self.output_layers=output_image,layers
+                    with self._stage('write'):
+                        written=self.writeOutputImage(output_filenames[i_conf])
+                    if written!=0:
+                        print("ERROR: Problem during output writing of configuration "+str(configurations[i_conf])+".")
+                        result=-1
+                    elif result_keys.get(i_conf) is not None:
+                        self.storeResult(output_filenames[i_conf],result_keys[i_conf])
+                self.angle_outputs=None
+        finally:
+            self.persistent_pool=persistent_pool
+            if not persistent_pool:
+                self.close()
+
+        return result
+
+
+    def _traced(self):
+        """ True if the working rows are traced through the not rotated input working image ('trace' oblique mode,
+        see _prepareWorkingImage). """
+        return self.working_rotation!=0 and self.working_oblique=='trace'
+
+
+    def _simulateWorkingRows(self,sim_function,output_array,rsp=None,rows=None):
+        """ Simulates the working rows (first row, last row + 1) of the input working image, all of them if rows is None,
+        into the same rows of output_array (see _simulateRows). With the 'trace' oblique mode the rotated working image
+        is never built: the working rows are traced through the input image by strips of trace_strip_rows rows (see
+        image.traceWindow), and each strip is simulated straight into its rows of output_array, so that only one strip
+        of the rotated grid is held at a time and the input heights are not interpolated. Returns 0 on success, -1
+        otherwise. """
+        iwsize=self.row_sim_parameters.iwsize
+        if rows is None:
+            rows=(0,iwsize[0])
+        if not self._traced():
+            return self._simulateRows(sim_function,self.input_working_image.image[rows[0]:rows[1]],output_array[...,rows[0]:rows[1],:],rsp)
+
+        if self.debug_mode:
+            print("INFO: Tracing input DEM rows along the "+str(self.working_rotation)+" degrees direction to simulate aspect angle+direction...")
+        #~ one monitor follows all the strips, and one pool simulates them
+        monitor=self._rowMonitor(rows[1]-rows[0])
+        persistent_pool=self.persistent_pool
+        self.persistent_pool=True
+        try:
+            for iY in range(rows[0],rows[1],self.trace_strip_rows):
+                strip_size=(min(self.trace_strip_rows,rows[1]-iY),iwsize[1])
+                with self._stage('trace',first_row=iY):
+                    input_strip=self.input_working_image.traceWindow(self.working_rotation,self.row_sim_parameters.nodatav,(iY,0),strip_size)
+                if self._simulateRows(sim_function,input_strip,output_array[...,iY:iY+strip_size[0],:],rsp,monitor)!=0:
+                    return -1
+        finally:
+            self.persistent_pool=persistent_pool
+            if not persistent_pool:
+                self.close()
+        return 0
+
+
+    def _simulateRows(self,sim_function,input_array,output_array,rsp=None,monitor=None):
+        """ Runs sim_function on every row of input_array (rows of the input working image) and stores the results
+        into output_array, using the selected parallel backend: 'pool' sends chunks of rows to a multiprocessing.Pool,
+        'shared_memory' places input and output arrays in shared memory and hands out row blocks, 'threads' hands
+        out row blocks to threads writing directly into output_array, 'auto' chooses among them and the simulation
+        in this process (see parallel.auto_backend). rsp, if given, replaces the simulation parameters passed to
+        sim_function (e.g. the list of parameters of multi_angle_engine).
+        Rows are collected as they are done, so that the progress is reported to progress_callback and the simulation
+        is interrupted as soon as cancel_event is set or the deadline is passed (see parallel.row_monitor; monitor, if
+        given, is the one following a simulation made of several calls). On interruption, or on any exception (e.g.
+        KeyboardInterrupt), the worker pool is terminated. Returns 0 on success, -1 otherwise. """
+
+        if rsp is None:
+            rsp=self.row_sim_parameters
+        if monitor is None:
+            monitor=self._rowMonitor(input_array.shape[0])
+
+        try:
+            return self._runRows(sim_function,input_array,output_array,rsp,monitor)
+        except parallel.simulation_interrupted as e:
+            self.interruption=e.reason
+            print("ERROR: Simulation "+("cancelled" if e.reason=='cancelled' else "stopped at its deadline")+" after "+str(e.rows_done)+"/"+str(e.n_rows)+" rows.")
+            return -1
+
+
+    def _rowMonitor(self,n_rows):
+        """ Returns the parallel.row_monitor of the simulation of n_rows rows, or None if no progress callback,
+        cancel event and deadline are set. """
+        self.interruption=None
+        if self.progress_callback is None and self.cancel_event is None and self.deadline is None:
+            return None
+        return parallel.row_monitor(n_rows,self.progress_callback,self.cancel_event,self.deadline)
+
+
+    def _rowsBackend(self,shape):
+        """ Returns the backend simulating working rows of the given shape ((..., rows, columns)): backend, or the one
+        chosen for them by 'auto' (see parallel.auto_backend). """
+        if self.backend=='auto':
+            return parallel.auto_backend(self.engine,shape[-2],shape[-1],self.n_subprocesses)
+        return self.backend
+
+
+    def _sharedMemory(self,shape):
+        """ True if working rows of the given shape are simulated by the shared_memory backend: the input and output
+        working images are then allocated directly in shared memory (see parallel.shared_array), where its worker
+        processes read and write them in place. """
+        return self.n_subprocesses>1 and self.backend in parallel_backends and self._rowsBackend(shape)=='shared_memory'
+
+
+    def _shareWorkingImage(self):
+        """ Moves the input working image into shared memory if its rows are simulated by the shared_memory backend.
+        It is kept there, so that the following simulations of the same working image (e.g. other incidence angles)
+        do not copy it again. Traced working rows (see _simulateWorkingRows) are shared strip by strip instead. """
+        img=self.input_working_image
+        if not self._traced() and self._sharedMemory(img.image.shape) and parallel.shared_location(img.image) is None:
+            img.image=parallel.shared_array(img.image.shape,img.image.dtype,img.image)
+
+
+    def _outputWorkingArray(self,shape,dtype):
+        """ Returns a new array of zeros holding working rows of the output image, of the given shape, in shared memory
+        if they are simulated by the shared_memory backend. """
+        if self._sharedMemory(shape):
+            return parallel.shared_array(shape,dtype)
+        return numpy.zeros(shape,dtype=dtype)
+
+
+    def _runRows(self,sim_function,input_array,output_array,rsp,monitor):
+        """ Body of _simulateRows, raising parallel.simulation_interrupted on interruption. Returns 0 on success, -1
+        otherwise. """
+
+        n_rows=input_array.shape[0]
+        profiler=self.profiler
+        if monitor is not None:
+            monitor.check()
+
+        if self.backend not in parallel_backends:
+            print("ERROR: Unknown parallel backend '"+str(self.backend)+"'.")
+            return -1
+        backend=self._rowsBackend(input_array.shape)
+        if self.backend=='auto' and self.debug_mode:
+            print("INFO: Parallel backend chosen automatically: "+backend)
+
+        self.multiprocessing_enabled=True
+        if backend in ('pool','shared_memory'):
             try:
                 from multiprocessing import Pool
             except:
                 self.multiprocessing_enabled=False
 
+        if not self.multiprocessing_enabled:
+            print("WARNING: Multiprocessing not possible on this machine. Simulating with 1 process.")
+
+        if not self.multiprocessing_enabled or backend=='serial' or (backend in ('shared_memory','threads') and self.n_subprocesses<=1):
+            t0=time.perf_counter()
+            task_function=parallel.sim_block if profiler is None else profiler.workerFunction(parallel.sim_block)
+            #~ rows are simulated by blocks of about 1% of the rows when monitored, in one block otherwise
+            block_rows=n_rows if monitor is None else max(1,n_rows//100)
+            with self._stage('rows',rows=n_rows,n_subprocesses=1):
+                tasks=list()
+                for block in parallel.row_blocks(n_rows,block_rows):
+                    tasks.append(task_function(input_array,output_array,block,rsp,sim_function))
+                    if monitor is not None:
+                        monitor.update(block[1]-block[0])
+            if profiler is not None:
+                profiler.addWorkerResults('rows',tasks,time.perf_counter()-t0)
 
-            results=None
-            if self.multiprocessing_enabled:
+        else:
+            if backend=='pool':
                 if self.debug_mode:
-                    print("INFO: Simulating with "+str(self.n_subprocesses)+" subprocesses...")
-                pool=Pool(self.n_subprocesses)
-                results=pool.map(sim_row,map_list)
-            else:
-                print("WARNING: Multiprocessing not possible on this machine. Simulating with 1 process.")
-                results=list(map(sim_row,map_list))
-            
-            if self.debug_mode:
-                print("INFO: Reassembling results into one single image...")            
-            for iY in range(0,rsp.iwsize[0]):
-                self.output_image.image[iY]=numpy.array(results[iY])
+                    print("INFO: Preparing input data for multiprocessing...")
+                with self._stage('prepare_tasks'):
+                    #~ rows are sent by chunks (as Pool.map would do), each task giving back its first row index
+                    map_list=list()
+                    chunk_rows=self.block_rows if self.block_rows is not None else parallel.default_block_rows(n_rows,self.n_subprocesses)
+                    for first_row,last_row in parallel.row_blocks(n_rows,chunk_rows):
+                        map_list.append((first_row,[(input_array[iY],rsp) for iY in range(first_row,last_row)]))
 
+            if self.debug_mode:
+                print("INFO: Simulating with "+str(self.n_subprocesses)+" subprocesses ("+self.engine+" engine, "+backend+" backend)...")
+            with self._stage('pool_start'):
+                pool=self._getPool(backend)
+            t0=time.perf_counter()
+            feeder=None
+            try:
+                with self._stage('rows',rows=n_rows,n_subprocesses=self.n_subprocesses):
+                    if backend!='pool':
+                        task_wrapper=None if profiler is None else lambda function: profiler.workerFunction(function,backend=='threads')
+                        results=pool.simulate(input_array,output_array,rsp,sim_function,self.block_rows,task_wrapper,monitor)
+                    else:
+                        task_function=parallel.chunk_function(sim_function if profiler is None else profiler.workerFunction(sim_function))
+                        feeder=parallel.task_feeder(map_list,self.n_subprocesses)
+                        results=parallel.wait_results(pool.imap_unordered(task_function,feeder),len(map_list),monitor,lambda result: len(result[1]),feeder)
+            except BaseException:
+                #~ interruptions, errors and KeyboardInterrupt: the workers are stopped, never left running
+                if feeder is not None:
+                    feeder.stop()
+                self._releasePool(pool,True)
+                raise
+            wall_seconds=time.perf_counter()-t0
+            if not self.persistent_pool:
+                with self._stage('pool_stop'):
+                    self._releasePool(pool)
 
-            if self.user_opsize[0]!=0 or self.user_opsize[1]!=0:
-                scale_factors=[rsp.owpsize[i_psize]/self.user_opsize[i_psize] if self.user_opsize[i_psize]!=0 else 1 for i_psize in range(0,2)]
+            if profiler is not None:
+                if backend!='pool':
+                    profiler.addWorkerResults('rows',results,wall_seconds)
+                else:
+                    profiler.addWorkerResults('rows',[(1,stats) for first_row,rows in results for row,stats in rows],wall_seconds)
+                    results=[(first_row,[row for row,stats in rows]) for first_row,rows in results]
 
+            if backend=='pool':
                 if self.debug_mode:
-                    print("INFO: Resizing output image in order to simulate user defined pixel spacing.")
-                if self.output_image.resize(scale_factors,0)!=0:
-                    print("ERROR: Problem during image resizing. Using not resized image.")
+                    print("INFO: Reassembling results into one single image...")
+                with self._stage('reassembly'):
+                    for first_row,rows in results:
+                        for iY,row in enumerate(rows,first_row):
+                            output_array[...,iY,:]=row
 
+        return 0
 
-            if self.direction=='e':
-                if self.debug_mode:
-                    print("INFO: Rotating by 180 degrees to restore North position...")
-                if(self.output_image.rotate(180,True,0,0)!=0):
-                    print("ERROR: Problem during output image rotation. Using not rotated output.")
 
-                    
-            if self.rotate_back and self.aa!=0:
-                if self.debug_mode:
-                    print("INFO: Rotating back output image...")                
-                if(self.output_image.rotate(-self.aa,True,0,0)!=0):
-                    print("ERROR: Problem during output image rotation. Using not rotated output.")
-                osize_tmp=self.output_image.getImageInfo()[0]
-                tl_corner=(int(osize_tmp[0]/2)-int(self.isize[0]/2),int(osize_tmp[1]/2)-int(self.isize[1]/2))
-                if self.debug_mode:
-                    print("INFO: Cropping output image...")                  
-                if self.output_image.crop(tl_corner,self.isize)!=0:
-                    print("ERROR: Problem during output image cropping. Using not cropped output.")
-                    
-            return 0
+    def _stage(self,name,**fields):
+        """ Returns the context timing one stage of the simulation if a profiler is set (see profiling.profiler),
+        an empty context otherwise. """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name,**fields)
+
+
+    def _getPool(self,backend):
+        """ Returns the worker pool of backend. If persistent_pool is set, the pool is created once and reused
+        by the following simulations, as long as backend and number of subprocesses do not change. """
+
+        if self.pool is not None:
+            if self.pool_config==(backend,self.n_subprocesses):
+                return self.pool
+            self.close()
+
+        if backend=='shared_memory':
+            pool=parallel.shared_memory_pool(self.n_subprocesses)
+        elif backend=='threads':
+            pool=parallel.thread_pool(self.n_subprocesses)
+        else:
+            from multiprocessing import Pool
+            pool=Pool(self.n_subprocesses)
+
+        if self.persistent_pool:
+            self.pool=pool
+            self.pool_config=(backend,self.n_subprocesses)
+        return pool
+
+
+    def _releasePool(self,pool,terminate=False):
+        """ Stops pool, terminating its workers if terminate is set, otherwise letting them finish. """
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        #~ shared_memory_pool and thread_pool wait for their workers in close and terminate,
+        #~ multiprocessing pools only when joined
+        if not isinstance(pool,(parallel.shared_memory_pool,parallel.thread_pool)):
+            pool.join()
+        if pool is self.pool:
+            self.pool=None
+
+
+    def close(self):
+        """ Stops the persistent worker pool, if any. """
+        if self.pool is not None:
+            self._releasePool(self.pool)
+
+
+    def simulateStreaming(self,output_filename,strip_rows=256):
+        """ Simulates an input image set with image.readInfo, i.e. whose data is still on disk, without ever
+        loading it entirely. Once the DEM is rotated to aspect angle 0, rows are independent: the input working
+        image is thus produced by strips of strip_rows rows through windowed reads (and tiled rotations, see
+        image.readRotatedWindow), each strip is simulated and the output rows are written incrementally to
+        output_filename. The reference height is computed from a streamed histogram of the not rotated input
+        (see _heightHistogram).
+        The output is given in slant range geometry (restored North position for direction 'e'): user defined
+        pixel spacing and rotate back are not supported in this mode. """
+
+        if self.input_working_image is None or self.input_working_image.filename is None:
+            print("ERROR: No input image file has been selected for streaming.")
+            return -1
+        if self.user_opsize[0]!=0 or self.user_opsize[1]!=0 or (self.rotate_back and self.aa!=0):
+            print("ERROR: User defined pixel spacing and rotate back are not supported in streaming mode.")
+            return -1
+        sim_function=self._rowFunction()
+        if sim_function is None:
+            return -1
+
+        rsp=self.row_sim_parameters
+        src=self.input_working_image
+
+        aa_tmp=None
+        if self.aa!=0 or self.direction!='w':
+            aa_tmp=(0 if self.direction=='w' else -180)+self.aa
+            self._updateWorkingImageSizes(rotation_geometry(self.isize,aa_tmp,True)[2])
         else:
+            self._updateWorkingImageSizes(self.isize)
+
+        if self.debug_mode:
+            print("INFO: Calculating streamed height histogram...")
+        with self._stage('histogram'):
+            #~ the input working image is not in memory: the 'full' estimator uses the whole not rotated input
+            hist,bin_edges=self._heightHistogram(strip_rows)
+            if hist.sum()==0:
+                print("ERROR: The input image contains only nodata values.")
+                return -1
+            self._setReferenceHeight(hist,bin_edges)
+        self._setOutputImageOffset()
+
+        if self.layers:
+            matrix,offset=numpy.identity(2),numpy.zeros((2,))
+            if self.direction=='e':
+                matrix,offset=-matrix,numpy.array(rsp.owsize)-1.
+
+        self.output_image=image(rsp.owsize,rsp.owpsize)
+        #~ the maximum scatterer count is not known in advance
+        self._setOutputFormat(self.output_image,None)
+        if self.output_image.create(output_filename,len(output_layers) if self.layers else 1,output_layers if self.layers else None)!=0:
+            print("ERROR: Problem during output image creation.")
+            return -1
+
+        if self.debug_mode:
+            print("INFO: Simulating "+str(rsp.iwsize[0])+" rows by strips of "+str(strip_rows)+" rows...")
+        #~ one monitor follows all the strips
+        monitor=self._rowMonitor(rsp.iwsize[0])
+        file_type=self.output_image.fileType()
+        clipped=False
+        try:
+            for iY in range(0,rsp.iwsize[0],strip_rows):
+                strip_size=(min(strip_rows,rsp.iwsize[0]-iY),rsp.iwsize[1])
+                with self._stage('read',first_row=iY):
+                    if aa_tmp is None:
+                        input_strip=src.readWindow((iY,0),strip_size)
+                    else:
+                        input_strip=self._workingWindow(src,aa_tmp,(iY,0),strip_size)
+                output_strip=self._outputWorkingArray(((len(working_layers),) if self.layers else ())+(strip_size[0],rsp.owsize[1]),numpy.float32 if self.layers else rsp.count_type)
+                if self._simulateRows(sim_function,input_strip,output_strip,None,monitor)!=0:
+                    if self.interruption is not None:
+                        print("ERROR: Rows from row "+str(iY)+" on not simulated: partial output written.")
+                    return -1
+                if self.layers:
+                    bands=list(output_strip[:-1])+list(lut_coordinates(output_strip[-1],iY,matrix,offset,rsp.owsize))
+                else:
+                    bands=[output_strip]
+                if file_type.kind!='f' and not clipped:
+                    #~ the type was chosen before the maximum scatterer count was known: clipping is reported once
+                    max_value=max([int(band.max()) if band.size>0 else 0 for band in bands])
+                    if max_value>numpy.iinfo(file_type).max:
+                        print("WARNING: Output values up to "+str(max_value)+" (rows from "+str(iY)+" on) do not fit into "+str(file_type)+": values are clipped.")
+                        clipped=True
+                result=0
+                with self._stage('write',first_row=iY):
+                    for i_band in range(0,len(bands)):
+                        if self.direction=='e':
+                            #~ 180 degrees rotation to restore North position
+                            result|=self.output_image.writeWindow(bands[i_band][::-1,::-1],(rsp.owsize[0]-iY-strip_size[0],0),i_band+1)
+                        else:
+                            result|=self.output_image.writeWindow(bands[i_band],(iY,0),i_band+1)
+                if result!=0:
+                    print("ERROR: Problem during output writing.")
+                    return -1
+        finally:
+            self.output_image.close()
+
+        return 0
+
+
+    def simulatePreview(self,level=None,max_pixels=2**18):
+        """ Simulates the current viewing geometry on a reduced resolution level of the input image (see
+        common.pyramid.pyramid), as a quick preview of the layover and shadow structure. Level l is reduced by 2**l: its
+        pixel spacing, and thus the input and output working pixel sizes of the simulation, are scaled accordingly, as
+        well as user defined output pixel spacing. If level is None, the first level with at most max_pixels pixels is
+        used. The pyramid and the simulator of each level are kept, so that further previews (e.g. with other angles)
+        only simulate the reduced level. The preview is given by getPreviewImage; simulate gives the full resolution
+        result. Previews are simulated in this process, since starting the subprocesses would take longer than the
+        simulation itself. """
+
+        if self.input_image is None:
             print("ERROR: No input image has been selected.")
             return -1
 
-    
+        rsp=self.row_sim_parameters
+
+        if self.preview_pyramid is None:
+            self.preview_pyramid=pyramid(self.input_image,rsp.nodatav)
+        if level is None:
+            level=self.preview_pyramid.levelForSize(max_pixels)
+
+        preview=self.preview_simulators.get(level)
+        if preview is None:
+            if self.debug_mode:
+                print("INFO: Preparing preview level "+str(level)+" (input reduced by "+str(2**level)+")...")
+            with self._stage('preview_level',level=level):
+                img=self.preview_pyramid.getLevel(level)
+            if img is None:
+                print("ERROR: Problem during the reduction of the input image.")
+                return -1
+            #~ the shared memory backend with one process simulates in this process, with no pool at all
+            preview=simulator(img=img,sp=1,debug_mode=self.debug_mode,engine=self.engine,backend='shared_memory')
+            self.preview_simulators[level]=preview
+
+        #~ settings are copied at each preview, since they can change between previews
+        preview.user_opsize=tuple(p*2**level for p in self.user_opsize)
+        preview.rotate_back=self.rotate_back
+        preview.row_sim_parameters.shadow_tol=rsp.shadow_tol
+        preview.layover_tol=self.layover_tol
+        preview._updateAngularParameters()
+        preview.layers=self.layers
+        preview.n_hist_bins=self.n_hist_bins
+        preview.height_estimator=self.height_estimator
+        preview.height_sample_rate=self.height_sample_rate
+        preview.height_min_samples=self.height_min_samples
+        preview.rotation_cache=self.rotation_cache
+        preview.oblique=self.oblique
+        preview.output_type=self.output_type
+        preview.compression=self.compression
+        preview.overviews=self.overviews
+        preview.profiler=self.profiler
+        preview.row_sim_parameters.shadow_max_iterations=rsp.shadow_max_iterations
+        preview.setAngles(rsp.ia,self.aa,self.direction)
+
+        with self._stage('preview',level=level):
+            result=preview.simulate()
+        if result!=0:
+            return -1
+        self.preview_image=preview.getOutputImage()
+        self.preview_level=level
+        return 0
+
+
     def getOutputImage(self):
         return self.output_image
+
+
+    def getPreviewImage(self):
+        return self.preview_image
+
+
+    def writePreviewImage(self,filename):
+        """ Writes the last preview (see simulatePreview) as writeOutputImage does for the output image. """
+        if self.preview_image is None:
+            return -1
+        return self.preview_simulators[self.preview_level].writeOutputImage(filename)
         
 
 
@@ -244,6 +1247,9 @@ class row_sim_parameters:
         self.s_angular_factor=saf
         self.shadow_tol=st
         self.d_h_lo_min=dl
+        self.shadow_max_iterations=8     #~ fixed point iterations of the vectorized shadow propagation before using shadow_pass
+        self.layers=False                #~ if True, the row functions also compute the working layers (see working_layers)
+        self.count_type=numpy.float32    #~ type of the rows returned by the row functions when no output row is given
         
         self.setIA(ia)
         
@@ -257,28 +1263,49 @@ class row_sim_parameters:
 
 
 
-def sim_row(row_data):
+def sim_row(row_data,out=None):
     """ Performs the pseudo-simulation of one single row of the input image.
     The simulation is always carried out considering the sensor viewing from
-    left to right. """
+    left to right. If out is given, the result is written in place into it
+    (e.g. a row of the output working image) and out is returned. If rsp.layers
+    is set, the result is an array of len(working_layers) rows: the scatterer
+    count followed by the other working layers (see working_layers). """
     
-    row=row_data[0]
+    row=numpy.asarray(row_data[0])
     rsp=row_data[1]
 
-    #~ set support arrays to min/max possible value for convenience
-    row_sh=[numpy.finfo('d').min for iX in range(0,rsp.iwsize[1])]
-    row_d=[numpy.finfo('d').max for iX in range(0,rsp.iwsize[1])]
+    #~ only the valid span of the row is simulated, and flat runs following a lit position are simulated in bulk
+    activity=row_activity(row,rsp)
+    x0,x1,run_end=activity
+
+    #~ shadowed positions and heights until which the lit positions are anyway shadowed (used in layover calculations)
+    shadowed,row_sh=shadow_pass(row,rsp,activity)
+
+    #~ set support array to max possible value for convenience
+    d_max=numpy.finfo('d').max
+    row_d=[d_max]*rsp.iwsize[1]
     
     #~ the output array is set to 0
-    row_result=numpy.zeros((rsp.owsize[1],),dtype=numpy.float32)
+    result=_row_result(rsp,out)
+    row_result=result[0] if rsp.layers else result
+    layover=result[2] if rsp.layers else None
+
+    #~ for each column of the valid span of the input row...
+    iX=x0
+    while iX<x1:
+        if run_end is not None and run_end[iX]>0 and not shadowed[iX-1]:
+            #~ flat run following a lit position: every position is lit and generates no layover
+            x_end_run=run_end[iX]
+            x_run=numpy.arange(iX,x_end_run)
+            x_start_run=_slant_range_positions(x_run,row[iX:x_end_run].astype(activity_type(row)),rsp)
+            row_d[iX:x_end_run]=x_start_run.tolist()
+            numpy.add.at(row_result,x_start_run[(x_start_run>=0)&(x_start_run<rsp.owsize[1])],1)
+            iX=x_end_run
+            continue
 
-    h_prev=numpy.finfo('d').max
-    
-    #~ for each column of the input row...
-    for iX in range(0,rsp.iwsize[1]):
         h=row[iX]
         if h != rsp.nodatav:
-            if row_sh[iX]<numpy.finfo('d').max:   #~ position is not shadowed
+            if not shadowed[iX]:
                 d=h*rsp.cos_ia      #~ position of the current point in the slant range image [m]
 
                 #~ actual position on the output image [pixels], that is also the beginning of a possible layover area
@@ -294,21 +1321,6 @@ def sim_row(row_data):
                     else:
                         x_start_layover=-1
                 
-                #~ compares the heights of all the pixels on the right of the current one to the current height
-                #~ to determine whether those pixels are shadowed. The check stops when one position is not shadowed
-                iSh=iX+1
-                shadowed=True
-                while iSh<rsp.iwsize[1] and shadowed==True:
-                    h_sh=row[iSh]
-                    d_h=h-h_sh
-                    d_h_min=rsp.s_angular_factor*(iSh-iX-rsp.shadow_tol)
-                    if d_h>=d_h_min:
-                        row_sh[iSh]=numpy.finfo('d').max        # position iSh (ground range, on input DTM/DSM) is shadowed
-                        iSh+=1
-                    else:
-                        shadowed=False
-                        row_sh[iSh]=h-d_h_min     #~ the slope/facade is anyway shadowed until this height (used in layover calculations)
-                
                 #~ check whether the current position generates a layover area
                 if x_start_layover>=0:
                     iLo=iX-1
@@ -326,16 +1338,324 @@ def sim_row(row_data):
                                     if x_end_layover>=rsp.owsize[1]:
                                         x_end_layover=rsp.owsize[1]-2
                                     row_result[x_start_layover:x_end_layover+1]+=1          #~ update output image
+                                    if layover is not None:
+                                        layover[x_start_layover:x_end_layover+1]=1
                                     
                         else:                   #~ full layover: the whole slope/facade generates layover
                             d_h=h-h_lo_prev
-                            if d_h>=rsp.d_h_lo_min and row_d[iLo]>=x_start_layover and row_d[iLo]!=numpy.finfo('d').max:
+                            if d_h>=rsp.d_h_lo_min and row_d[iLo]>=x_start_layover and row_d[iLo]!=d_max:
                                 x_end_layover=row_d[iLo]
                                 if x_end_layover>=rsp.owsize[1]:
                                     x_end_layover=rsp.owsize[1]-2
                                 row_result[x_start_layover:x_end_layover+1]+=1              #~ update output image
-            h_prev=h
+                                if layover is not None:
+                                    layover[x_start_layover:x_end_layover+1]=1
+        iX+=1
+
+    if rsp.layers:
+        row_d=numpy.array(row_d)
+        result[1]=numpy.array(shadowed)&(numpy.asarray(row)!=rsp.nodatav)
+        result[3]=numpy.where((row_d!=d_max)&(row_d>=0)&(row_d<rsp.owsize[1]),row_d,-1)
+
+    return result
+
+
+def shadow_pass(row,rsp,activity=None):
+    """ Determines the shadowed positions of one row in one single sweep. A running shadow horizon is kept,
+    given by the last lit position: a position is shadowed if it lies under the horizon, i.e. if
+    h_horizon-h>=s_angular_factor*(distance-shadow_tol), otherwise it is lit and becomes the new horizon.
+    A lit nodata position resets the horizon. Returns the list of shadow flags and, for each lit position,
+    the height until which it is anyway shadowed by the previous horizon (numpy.finfo('d').min if there
+    is no horizon); the latter is used in layover calculations. If the activity index of the row is given
+    (see row_activity), only its valid span is swept (positions outside of it are left lit) and its flat runs
+    following a lit position are set in bulk. """
+
+    n_cols=len(row)
+    shadowed=[False]*n_cols
+    row_sh=[numpy.finfo('d').min]*n_cols
+    x0,x1,run_end=(0,n_cols,None) if activity is None else activity
+
+    i_horizon=-1
+    h_horizon=None
+    iX=x0
+    while iX<x1:
+        if run_end is not None and run_end[iX]>0 and i_horizon==iX-1:
+            #~ flat run following a lit position: every position is lit and becomes in turn the horizon
+            x_end_run=run_end[iX]
+            row_sh[iX:x_end_run]=list(row[iX-1:x_end_run-1].astype(activity_type(row))-rsp.s_angular_factor*(1-rsp.shadow_tol))
+            i_horizon=x_end_run-1
+            h_horizon=row[i_horizon]
+            iX=x_end_run
+            continue
+        h=row[iX]
+        if i_horizon>=0:
+            d_h_min=rsp.s_angular_factor*(iX-i_horizon-rsp.shadow_tol)
+            if h_horizon-h>=d_h_min:
+                shadowed[iX]=True
+                iX+=1
+                continue
+            row_sh[iX]=h_horizon-d_h_min
+        if h != rsp.nodatav:
+            i_horizon=iX
+            h_horizon=h
         else:
-            h_prev=numpy.finfo('d').max
+            i_horizon=-1
+        iX+=1
+
+    return shadowed,row_sh
+
+
+def activity_type(row):
+    """ Type of the result of mixed operations between one height of row and a python float in sim_row
+    (float32 with NEP 50 promotion rules, float64 with the legacy ones). """
+    return numpy.dtype(type(row.dtype.type(0)*1.))
+
+
+def row_activity(row,rsp,flat_runs=True,min_run=8):
+    """ Activity index of one row of the input working image, used by the row engines to skip the parts of the
+    row where nothing can happen. Returns the valid span of the row (first valid column, last valid column + 1;
+    (0,0) if there are none), outside of which nothing is simulated: the positions before it are nodata, so
+    there is no shadow horizon at its start, and the positions after it do not affect the previous ones. If
+    flat_runs is set, it also returns, for each column, the end of the flat run it belongs to (0 if none;
+    None if there are no runs). A position is flat if it and the previous one are valid and the height step
+    between them is below both the shadow threshold (a drop smaller than s_angular_factor*(1-shadow_tol)) and
+    the layover threshold (a rise smaller than d_h_lo_min): a flat position following a lit position is lit,
+    and generates no layover, so the rest of the run only adds one scatterer per position and can be simulated
+    in bulk. Runs shorter than min_run positions are not reported. With shadow_tol>=1 there are no flat runs. """
+
+    row=numpy.asarray(row)
+    ftype=activity_type(row)
+    valid=row.astype(ftype)!=rsp.nodatav
+    i_valid=numpy.flatnonzero(valid)
+    if i_valid.size==0:
+        return 0,0,None
+    x0,x1=int(i_valid[0]),int(i_valid[-1])+1
+    if not flat_runs or rsp.shadow_tol>=1 or x1-x0<=min_run:
+        return x0,x1,None
+
+    #~ same comparisons of sim_row between consecutive positions
+    d_h=(row[1:]-row[:-1]).astype(ftype)
+    d_h_sh=(row[:-1]-row[1:]).astype(ftype)
+    flat=numpy.zeros(row.shape,dtype=bool)
+    flat[1:]=valid[1:]&valid[:-1]&~(d_h_sh>=numpy.array(rsp.s_angular_factor*(1-rsp.shadow_tol)).astype(ftype))&~(d_h>=rsp.d_h_lo_min)
+
+    edges=numpy.diff(flat.astype(numpy.int8),prepend=0,append=0)
+    starts=numpy.flatnonzero(edges==1)
+    stops=numpy.flatnonzero(edges==-1)
+    long_runs=stops-starts>=min_run
+    if not long_runs.any():
+        return x0,x1,None
+    run_end=numpy.zeros(row.shape,dtype=numpy.int64)
+    for start,stop in zip(starts[long_runs],stops[long_runs]):
+        run_end[start:stop]=stop
+    return x0,x1,run_end.tolist()
+
+
+def _slant_range_positions(x,h,rsp):
+    """ Output working columns of the scatterers at input working columns x with heights h (given in the type
+    of sim_row scalar arithmetic, see activity_type), computed with the same expressions of sim_row. """
+    x_ground=(x*rsp.iwpsize[1]*rsp.sin_ia/rsp.owpsize[1]).astype(h.dtype)
+    d=h*rsp.cos_ia
+    return numpy.rint(x_ground-d/rsp.owpsize[1]-rsp.output_working_image_offset).astype(numpy.int64)
+
+
+def _row_result(rsp,out):
+    if out is None:
+        return numpy.zeros((len(working_layers),rsp.owsize[1]) if rsp.layers else (rsp.owsize[1],),dtype=numpy.float32 if rsp.layers else rsp.count_type)
+    out[:]=0
+    return out
+
+
+def sim_row_vectorized(row_data,out=None):
+    """ Array based version of sim_row: slant range positions, shadow state, layover spans and counts
+    are computed with numpy operations over the whole row instead of pixel by pixel.
+    The result is the same as the one of sim_row: every comparison and rounding is carried out with
+    the same expressions and in the same floating point type that sim_row gets from numpy scalar
+    arithmetic (float32 with NEP 50 promotion rules, float64 with the legacy ones). If out is given, the
+    result is written in place into it and out is returned. """
+
+    row=numpy.asarray(row_data[0])
+    rsp=row_data[1]
+
+    owidth=rsp.owsize[1]
+    result=_row_result(rsp,out)
+    row_result=result[0] if rsp.layers else result
+    if rsp.layers:
+        result[3]=-1
+
+    #~ only the valid span of the row is simulated (see row_activity)
+    x0,x1,run_end=row_activity(row,rsp,False)
+    n_cols=x1-x0
+    if n_cols==0:
+        return result
+    row=row[x0:x1]
+
+    #~ type of the result of mixed operations between one height and a python float in sim_row
+    ftype=activity_type(row)
+    row_f=row.astype(ftype)
+    valid=row_f!=rsp.nodatav
+    x=numpy.arange(x0,x1)
+
+    lit,prev=_vectorized_shadow(row,valid,rsp,ftype)
+    lit_valid=lit&valid
+
+    #~ actual position on the output image [pixels], that is also the beginning of a possible layover area
+    x_start_layover=_slant_range_positions(x,numpy.where(valid,row_f,0),rsp)
+
+    #~ one scatterer for each lit position falling into the output image
+    in_image=lit_valid&(x_start_layover>=0)&(x_start_layover<owidth)
+    numpy.add(row_result,numpy.bincount(x_start_layover[in_image],minlength=owidth),out=row_result,casting='unsafe')
+
+    if rsp.layers:
+        result[1][x0:x1]=~lit&valid
+        result[3][x0:x1]=numpy.where(in_image,x_start_layover,-1)
+
+    #~ positions before the output image start their layover area at 0, positions after it have none
+    x_start_clipped=numpy.where(x_start_layover<0,0,x_start_layover)
+    x_start_clipped[x_start_layover>=owidth]=-1
+    candidates=lit_valid&(x_start_clipped>=0)
+    candidates[0]=False
+    i_lo=numpy.nonzero(candidates)[0]
+    if i_lo.size==0:
+        return result
+
+    h=row[i_lo]
+    h_prev=row[i_lo-1]
+    x_start=x_start_clipped[i_lo]
+
+    #~ height until which the slope/facade is anyway shadowed; only defined when the previous lit pixel is valid
+    p=prev[i_lo]
+    sh_defined=(p>=0)&valid[numpy.maximum(p,0)]
+    p=numpy.where(sh_defined,p,i_lo)
+    d_h_min=(rsp.s_angular_factor*((i_lo-p)-rsp.shadow_tol)).astype(ftype)
+    h_sh=row_f[p]-d_h_min
+
+    #~ cut layover: part of the slope/facade is shadowed
+    cut=sh_defined&(h_sh>h_prev.astype(ftype))
+    d_end_layover=h_sh*rsp.cos_ia
+    x_end_cut=numpy.rint(((x[i_lo]*rsp.iwpsize[1]*rsp.sin_ia).astype(ftype)-d_end_layover)/rsp.owpsize[1]).astype(numpy.int64)-rsp.output_working_image_offset
+    cut_lo=cut&(row_f[i_lo]-h_sh>=rsp.d_h_lo_min)&(x_end_cut>=x_start)
+
+    #~ full layover: the whole slope/facade generates layover
+    x_end_full=x_start_layover[i_lo-1]
+    full_lo=~cut&((h-h_prev).astype(ftype)>=rsp.d_h_lo_min)&lit_valid[i_lo-1]&(x_end_full>=x_start)
+
+    x_end=numpy.where(cut_lo,x_end_cut,x_end_full)
+    x_end[x_end>=owidth]=owidth-2
+    layover=(cut_lo|full_lo)&(x_end>=x_start)
+    starts=x_start[layover]
+    stops=x_end[layover]+1
+
+    #~ layover spans are accumulated as a difference array
+    spans=numpy.bincount(starts,minlength=owidth+1)-numpy.bincount(stops,minlength=owidth+1)
+    coverage=numpy.cumsum(spans[:owidth])
+    numpy.add(row_result,coverage,out=row_result,casting='unsafe')
+    if rsp.layers:
+        result[2]=coverage>0
+
+    return result
+
+
+def _vectorized_shadow(row,valid,rsp,ftype):
+    """ Shadow propagation used by sim_row_vectorized. In sim_row a position is lit when it is not shadowed
+    by the last lit position on its left, so the lit positions form a chain. The chain is computed as the
+    fixed point of a vectorized update: each position is compared with the last lit position of the previous
+    estimate. The first estimate comes from the cumulative maximum of the shadow horizon (h + s_angular_factor*x)
+    and is usually already exact; each further iteration fixes at least the first wrong position. If the
+    estimate is still changing after rsp.shadow_max_iterations iterations (long chains of positions close to
+    the shadow_tol band), the chain is computed with the one sweep shadow_pass instead. Returns the lit flags
+    (nodata positions included, as in sim_row) and the index of the previous lit position (-1 if none). """
+
+    n_cols=row.shape[0]
+    x=numpy.arange(n_cols)
+
+    horizon=numpy.where(valid,row.astype(numpy.float64)+rsp.s_angular_factor*x,-numpy.inf)
+    horizon_max=numpy.maximum.accumulate(horizon)
+    lit=numpy.ones((n_cols,),dtype=bool)
+    lit[1:]=horizon[1:]>horizon_max[:-1]+rsp.s_angular_factor*rsp.shadow_tol
+    lit|=~valid
+
+    converged=False
+    for i_iter in range(0,rsp.shadow_max_iterations):
+        prev=_previous_lit(lit)
+        p=numpy.maximum(prev,0)
+        d_h=(row[p]-row).astype(ftype)
+        d_h_min=(rsp.s_angular_factor*((x-p)-rsp.shadow_tol)).astype(ftype)
+        new_lit=~((prev>=0)&valid[p]&(d_h>=d_h_min))
+        if numpy.array_equal(new_lit,lit):
+            converged=True
+            break
+        lit=new_lit
+
+    if not converged:
+        lit=~numpy.array(shadow_pass(row,rsp)[0],dtype=bool)
+        prev=_previous_lit(lit)
+
+    return lit,prev
+
+
+def lut_coordinates(lut,first_row,matrix,offset,size):
+    """ Converts a working LUT layer (output working column of the scatterer of each input working pixel, -1 if none)
+    of the working rows starting at first_row into the row and column of the final output image, whose size is size.
+    matrix and offset give the transform from final output to working coordinates (working = matrix.dot(final)+offset),
+    which is inverted; scatterers falling outside the final output image get -1 as well. """
+    inv=numpy.linalg.inv(matrix)
+    d_row=numpy.arange(first_row,first_row+lut.shape[0],dtype=numpy.float64)[:,numpy.newaxis]-offset[0]
+    d_col=lut-offset[1]
+    rows=numpy.rint(inv[0,0]*d_row+inv[0,1]*d_col)
+    cols=numpy.rint(inv[1,0]*d_row+inv[1,1]*d_col)
+    valid=(lut>=0)&(rows>=0)&(rows<size[0])&(cols>=0)&(cols<size[1])
+    return numpy.where(valid,rows,-1).astype(numpy.float32),numpy.where(valid,cols,-1).astype(numpy.float32)
+
+
+def _previous_lit(lit):
+    prev=numpy.maximum.accumulate(numpy.where(lit,numpy.arange(lit.shape[0]),-1))
+    return numpy.concatenate(([-1],prev[:-1]))
+
+
+height_estimators=('full','input','sample','gdal')
+
+#~ layers computed by the row functions if row_sim_parameters.layers is set, all in working geometry: scatterer count (output
+#~ working image), shadow mask (1 = shadowed input pixel), layover mask (1 = output pixel in a layover area) and output working
+#~ column of the scatterer of each input pixel (-1 if shadowed, nodata or outside the output image)
+working_layers=('count','shadow','layover','lut')
+
+#~ data types of the output files: 'auto' = smallest integer type holding all the output values
+output_types=('float32','auto','uint8','uint16')
+
+#~ oblique modes, i.e. how the input image is brought to the viewing geometry when aspect angle or direction require it:
+#~ 'rotate' = cubic spline rotation, 'trace' = rows traced through the input image with nearest neighbour sampling,
+#~ by strips, when simulated (see _simulateWorkingRows)
+oblique_modes=('rotate','trace')
+
+#~ parallel backends of _simulateRows
+parallel_backends=('pool','shared_memory','threads','auto')
+
+#~ bands of the output images with layers: the working LUT is given as row and column of the final output image
+output_layers=('count','shadow','layover','lut_row','lut_column')
+
+row_engines={'reference':sim_row,'vectorized':sim_row_vectorized}
+
+#~ version of the output files in the result cache keys (see simulator.resultKey): to be increased whenever a change
+#~ of the simulation changes the output files, so that results cached by previous versions are no longer used
+result_key_version=1
+
+
+class multi_angle_engine:
+    """ Row function simulating one row for several incidence angles with the row function engine (e.g. one of
+    row_engines): row_data is (row, list of row_sim_parameters, one per angle) and the result stacks the results
+    of each angle, i.e. it has one more leading dimension than the result of engine. The row is converted once and
+    stays in cache while all the angles are simulated; a picklable object, so that it can be sent to worker processes. """
+
+    def __init__(self,engine):
+        self.engine=engine
+
 
-    return row_result
+    def __call__(self,row_data,out=None):
+        row=numpy.asarray(row_data[0])
+        rsp_list=row_data[1]
+        if out is None:
+            out=numpy.stack([_row_result(rsp,None) for rsp in rsp_list])
+        for i_angle,rsp in enumerate(rsp_list):
+            self.engine((row,rsp),out[i_angle])
+        return out